@@ -0,0 +1,250 @@
+"""
+Benchmarks of con_creator stages on synthetic layouts, needs the standalone klayout module.
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --cases grid arrays --sizes 1000 100000 10000000 --ebl cabl --json results.json
+
+Every case runs in a fresh process, so the peak memory (maximum resident set size after each stage)
+belongs to that case only. Stages: collection of shapes with doses, polygon_division, clipping to fields,
+decomposition into trapezoids, formatting of records and writing of files. The last three are measured
+inside the writers, with --processes their times are summed over the worker processes.
+Options of Calculus (--processes, --reuse, --merge, --scalar, --deep) allow to compare engines on the same layouts.
+The amount of collected shapes is checked against the flat region of every case.
+"""
+import sys
+import json
+import random
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from math import cos, sin, pi
+from os import walk, makedirs
+from os.path import dirname, abspath, join, getsize
+from time import perf_counter
+try:
+    import pya
+except ImportError:
+    import klayout.db as pya
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from con_creator.calculus import Calculus, Field  # noqa: E402
+from con_creator.telemetry import peak_memory  # noqa: E402
+
+FIELDS = {'cabl': (120, 60000), 'xenos': (100, 50000)}
+DOSES = [0.8, 0.9, 1.1, 1.25, 1.5]
+
+
+def side(n):
+    return max(1, int(round(n ** 0.5)))
+
+
+def with_dose(ly, dose):
+    return ly.properties_id([['dose', dose]])
+
+
+def make_grid(ly, top, layer, n):
+    # 1x1 um squares with 2 um pitch
+    m = side(n)
+    shapes = top.shapes(layer)
+    for i in range(m):
+        for j in range(m):
+            shapes.insert(pya.Box(i * 2000, j * 2000, i * 2000 + 1000, j * 2000 + 1000))
+
+
+def make_nonmanhattan(ly, top, layer, n):
+    # rotated triangles, hexagons and rounded squares with 3 um pitch
+    rnd = random.Random(1)
+    m = side(n)
+    shapes = top.shapes(layer)
+    for i in range(m):
+        for j in range(m):
+            cx, cy, a = i * 3000, j * 3000, rnd.uniform(0, 2 * pi)
+            kind = (i + j) % 3
+            if kind == 2:
+                poly = pya.Polygon(pya.Box(cx - 1000, cy - 1000, cx + 1000, cy + 1000)).round_corners(0, 400, 32)
+            else:
+                k = 3 if kind == 0 else 6
+                poly = pya.Polygon([pya.Point(int(cx + 1000 * cos(a + 2 * pi * t / k)),
+                                              int(cy + 1000 * sin(a + 2 * pi * t / k))) for t in range(k)])
+            shapes.insert(poly)
+
+
+def make_arrays(ly, top, layer, n):
+    # device of 4 shapes, 10x10 blocks of devices, array of blocks
+    dev = ly.create_cell('DEV')
+    dev.shapes(layer).insert(pya.Box(0, 0, 1000, 300))
+    dev.shapes(layer).insert(pya.Box(0, 700, 1000, 1000))
+    dev.shapes(layer).insert(pya.Polygon([pya.Point(0, 400), pya.Point(1000, 400), pya.Point(500, 600)]))
+    dev.shapes(layer).insert(pya.Box(1200, 0, 1400, 1000))
+    block = ly.create_cell('BLOCK')
+    block.insert(pya.CellInstArray(dev.cell_index(), pya.Trans(), pya.Vector(2000, 0), pya.Vector(0, 2000), 10, 10))
+    m = side(max(1, n // 400))
+    top.insert(pya.CellInstArray(block.cell_index(), pya.Trans(), pya.Vector(21000, 0), pya.Vector(0, 21000), m, m))
+
+
+def make_doses(ly, top, layer, n):
+    # half of the shapes carry own doses, the other half gets doses of their instances
+    rnd = random.Random(2)
+    m = side(n // 2)
+    shapes = top.shapes(layer)
+    for i in range(m):
+        for j in range(m):
+            shapes.insert(pya.Box(i * 2000, j * 2000, i * 2000 + 1000, j * 2000 + 1000),
+                          with_dose(ly, rnd.choice(DOSES)))
+    dev = ly.create_cell('DEV')
+    dev.shapes(layer).insert(pya.Box(0, 0, 1000, 1000))
+    for i in range(m):
+        for j in range(m):
+            inst = pya.CellInstArray(dev.cell_index(), pya.Trans(pya.Vector(i * 2000, -(j + 1) * 2000)))
+            top.insert(inst, with_dose(ly, rnd.choice(DOSES)))
+
+
+def make_field_layer(ly, top, layer, n):
+    # grid of squares with fields of 100 um on layer 100/0
+    make_grid(ly, top, layer, n)
+    fields = top.shapes(ly.layer(100, 0))
+    extent = side(n) * 2000
+    for x in range(-1000, extent, 100000):
+        for y in range(-1000, extent, 100000):
+            fields.insert(pya.Box(x, y, x + 100000, y + 100000))
+
+
+def make_straddling(ly, top, layer, n):
+    # stripes and diagonal paths longer than a field, nearly every shape is clipped
+    m = max(1, n // 2)
+    shapes = top.shapes(layer)
+    for i in range(m):
+        shapes.insert(pya.Box(0, i * 2000, 250000, i * 2000 + 1000))
+        shapes.insert(pya.Path([pya.Point(i * 2000, 0), pya.Point(i * 2000 + 150000, 150000)], 800).polygon())
+
+
+CASES = {
+    'grid': make_grid,
+    'nonmanhattan': make_nonmanhattan,
+    'arrays': make_arrays,
+    'doses': make_doses,
+    'fieldlayer': make_field_layer,
+    'straddling': make_straddling,
+}
+
+
+def make_layout(case, n):
+    ly = pya.Layout()
+    ly.dbu = 0.001
+    top = ly.create_cell('TOP')
+    CASES[case](ly, top, ly.layer(1, 0), n)
+    return ly, top
+
+
+def directory_size(path):
+    return sum(getsize(join(root, f)) for root, _, files in walk(path) for f in files)
+
+
+class NullLog:
+    def __init__(self):
+        self.messages = 0
+
+    def write(self, *args):
+        self.messages += 1
+
+
+def run_case(case, n, ebl, options):
+    # Runs all stages of one case, returns list of stage records
+    stages = []
+
+    def record(stage, start, count, nbytes=None, seconds=None):
+        seconds = perf_counter() - start if seconds is None else seconds
+        stages.append({'stage': stage, 'seconds': seconds, 'items': count,
+                       'items_per_s': count / seconds if seconds else None,
+                       'mb_per_s': nbytes / 2 ** 20 / seconds if nbytes is not None and seconds else None,
+                       'peak_mb': peak_memory()})
+
+    start = perf_counter()
+    ly, top = make_layout(case, n)
+    nshapes = pya.Region(top.begin_shapes_rec(ly.layer(1, 0))).count()
+    record('layout', start, nshapes)
+
+    field_layer = '100/0' if case == 'fieldlayer' else ''
+    size, dots = FIELDS[ebl]
+    with tempfile.TemporaryDirectory() as tmp:
+        out = join(tmp, 'chip')
+        worker = Calculus(ebl, out, Field(size, dots, [0.0, 0.0]), None, False, 'x', 1, 1.0, NullLog(),
+                          field_layer, options['merge'], processes=options['processes'],
+                          vectorized=not options['scalar'], reuse=options['reuse'], deep=options['deep'])
+        makedirs(out)
+        start = perf_counter()
+        worker.snapshot(ly, top, list(ly.layer_indexes()))
+        polygons = worker.polygons
+        collected = len(polygons) + worker.reused_shapes
+        record('collect', start, collected)
+        # layouts of the cases are built in memory, the collection must see every shape of the flat region
+        if collected != nshapes:
+            raise AssertionError('%s: collected %d of %d shapes' % (case, collected, nshapes))
+
+        start = perf_counter()
+        fields, shapes, buckets = worker.polygon_division(polygons)
+        record('division', start, len(shapes))
+
+        start = perf_counter()
+        clipped = list(worker.clipped_fields(fields, shapes, buckets))
+        record('clip', start, sum(len(polys) for _, entries, _ in clipped for _, polys in entries))
+
+        # fields are fractured once by the writers, their telemetry splits the time into the three stages
+        write = worker.write_files if ebl == 'cabl' else worker.write_pat_ctl
+        amount, nfields = write(iter(clipped))
+        worker.outlog.close()
+        stages_done = worker.telemetry.stages
+        for stage, name in (('fracture', 'fracture'), ('format', 'emit'), ('write', 'write')):
+            record(stage, 0, amount, directory_size(out) if stage == 'write' else None,
+                   stages_done.get(name, {}).get('wall', 0.0))
+    return {'case': case, 'size': n, 'ebl': ebl, 'shapes': nshapes, 'fields': nfields, 'stages': stages}
+
+
+def run_isolated(case, n, ebl, options):
+    # every case in a new process, so that peak memory is not inherited from previous cases
+    # workers of an executor may start processes of their own (--processes), those of Pool may not
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_case, case, n, ebl, options).result()
+
+
+def print_result(result):
+    head = '%s n=%d %s: %d shapes, %d fields' % (result['case'], result['size'], result['ebl'], result['shapes'],
+                                                   result['fields'])
+    print(head)
+    for s in result['stages']:
+        rate = '%12.0f /s' % s['items_per_s'] if s['items_per_s'] else '%14s' % '-'
+        mb = '%8.1f MB/s' % s['mb_per_s'] if s['mb_per_s'] else '%13s' % ''
+        print('    %-9s %9.3f s %10d %s %s  peak %8.1f MB' % (s['stage'], s['seconds'], s['items'], rate, mb,
+                                                                s['peak_mb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of con_creator on synthetic layouts.')
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=sorted(CASES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000], help='approximate shapes')
+    parser.add_argument('--ebl', nargs='+', choices=['cabl', 'xenos'], default=['cabl', 'xenos'])
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--reuse', action='store_true')
+    parser.add_argument('--merge', action='store_true')
+    parser.add_argument('--scalar', action='store_true', help='do not use the NumPy encoder')
+    parser.add_argument('--deep', action='store_true', help='hierarchical collection, shapes flattened per field')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+    options = {'processes': args.processes, 'reuse': args.reuse, 'merge': args.merge, 'scalar': args.scalar,
+               'deep': args.deep}
+
+    results = []
+    for case in args.cases:
+        for n in args.sizes:
+            for ebl in args.ebl:
+                result = run_isolated(case, n, ebl, options)
+                print_result(result)
+                results.append(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
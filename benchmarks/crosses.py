@@ -0,0 +1,129 @@
+"""
+Benchmark of the alignment cross detectors of image_insert/preparation.py on synthetic SEM images,
+needs opencv-python, peakutils and pandas.
+
+    python benchmarks/crosses.py
+    python benchmarks/crosses.py --sizes 1024 4096 --count 20 --noise 30 --engines projection --json results.json
+
+Every image has four crosses at the corners of a rectangle with known sub-pixel centers, bright or dark,
+on a background with a gradient, blurred, with Gaussian noise and an annotation bar at the bottom.
+For every engine and image width: images with four crosses found, images with all four centers closer
+than TOLERANCE to the true ones, time per image, mean and maximum distance of found centers from the true
+ones in pixels of the image (over all found images, wrong crosses included).
+"""
+import sys
+import json
+import argparse
+import tempfile
+from os.path import dirname, abspath, join
+from time import perf_counter
+import numpy as np
+import cv2 as cv
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'image_insert'))
+from preparation import find_crosses  # noqa: E402
+
+ENGINES = ('contours', 'projection')
+ANNOTATION = 0.0625  # part of the height covered by the annotation bar
+TOLERANCE = 2  # pixels, images with all centers closer to the truth are counted as correct
+
+
+def coverage(n, lo, hi):
+    # part of every pixel (pixel i covers i - 0.5 .. i + 0.5) inside the interval lo .. hi
+    i = np.arange(n)
+    return np.clip(np.minimum(hi, i + 0.5) - np.maximum(lo, i - 0.5), 0, 1)
+
+
+def draw_cross(canvas, cx, cy, length, thickness):
+    # antialiased '+' centered at cx, cy (pixel coordinates) added to canvas
+    h, w = canvas.shape
+    vx, vy = coverage(w, cx - thickness / 2, cx + thickness / 2), coverage(h, cy - length / 2, cy + length / 2)
+    hx, hy = coverage(w, cx - length / 2, cx + length / 2), coverage(h, cy - thickness / 2, cy + thickness / 2)
+    canvas += np.outer(vy, vx) + np.outer(hy, hx) - np.outer(hy, vx)
+
+
+def make_image(rnd, width, noise):
+    """
+    Synthetic image and true centers in the convention of find_crosses:
+    pixels from the image center, y upwards
+    """
+    height = width * 3 // 4
+    length = height * rnd.uniform(0.08, 0.15)
+    thickness = length * rnd.uniform(0.15, 0.3)
+    usable = height * (1 - ANNOTATION)
+    x0, y0 = rnd.uniform(0.1, 0.3) * width, rnd.uniform(0.1, 0.3) * usable
+    x1, y1 = width - rnd.uniform(0.1, 0.3) * width, usable - rnd.uniform(0.1, 0.3) * usable
+    centers = [(x0, y0), (x1, y0), (x0, y1), (x1, y1)]
+    crosses = np.zeros((height, width))
+    for cx, cy in centers:
+        draw_cross(crosses, cx, cy, length, thickness)
+    crosses = np.minimum(crosses, 1)
+
+    gx, gy = np.meshgrid(np.linspace(-1, 1, width), np.linspace(-1, 1, height))
+    background = 100 + 30 * (rnd.uniform(-1, 1) * gx + rnd.uniform(-1, 1) * gy)
+    contrast = rnd.uniform(60, 100) * rnd.choice([1, -1])
+    img = background + contrast * crosses
+    img = cv.GaussianBlur(img, (0, 0), max(0.5, width / 2048))
+    img += rnd.normal(0, noise, img.shape)
+    img[int(height * (1 - ANNOTATION)):] = 20
+    cv.putText(img, 'EHT = 10.00 kV  WD = 5 mm  Mag = 5.00 K X', (width // 50, height - height // 40),
+               cv.FONT_HERSHEY_SIMPLEX, width / 1500, 230, max(1, width // 700))
+    truth = [[cx - width / 2, -cy + height / 2 + 1] for cx, cy in centers]
+    truth.sort(key=lambda p: 2 * np.sign(p[1]) + np.sign(p[0]))
+    return np.clip(img, 0, 255).astype(np.uint8), truth
+
+
+def run(engines, sizes, count, noise, threshold, seed):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for width in sizes:
+            rnd = np.random.default_rng(seed)
+            images = []
+            for k in range(count):
+                img, truth = make_image(rnd, width, noise)
+                path = join(tmp, 'img_%d_%d.png' % (width, k))
+                cv.imwrite(path, img)
+                images.append((path, truth))
+            for engine in engines:
+                found, correct, seconds, errors = 0, 0, 0.0, []
+                for path, truth in images:
+                    start = perf_counter()
+                    pts = find_crosses(path, None, ANNOTATION, threshold, engine)
+                    seconds += perf_counter() - start
+                    if pts is not None:
+                        found += 1
+                        distances = np.hypot(*(np.array(pts) - np.array(truth)).T)
+                        correct += int(distances.max() < TOLERANCE)
+                        errors.extend(distances.tolist())
+                results.append({'engine': engine, 'width': width, 'images': count, 'found': found,
+                                 'correct': correct, 'seconds_per_image': seconds / count,
+                                 'mean_error_px': float(np.mean(errors)) if errors else None,
+                                 'max_error_px': float(np.max(errors)) if errors else None})
+                print_result(results[-1])
+    return results
+
+
+def print_result(r):
+    error = '%8.3f px mean %8.3f px max' % (r['mean_error_px'], r['max_error_px']) if r['found'] else ''
+    print('%-10s width %5d: %3d/%-3d found %3d correct %9.4f s/image  %s' % (
+        r['engine'], r['width'], r['found'], r['images'], r['correct'], r['seconds_per_image'], error))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of cross detectors on synthetic images.')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1024, 2048, 4096], help='image widths')
+    parser.add_argument('--count', type=int, default=10, help='images per width')
+    parser.add_argument('--noise', type=float, default=15, help='standard deviation of the noise in gray levels')
+    parser.add_argument('--threshold', choices=['Adaptive', 'Binary'], default='Binary')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+    results = run(args.engines, args.sizes, args.count, args.noise, args.threshold, args.seed)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
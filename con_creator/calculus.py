@@ -1,25 +1,44 @@
 from struct import Struct
 from time import time
-from os import listdir, remove
+import json
+from hashlib import sha1
+from array import array
+from concurrent.futures import ProcessPoolExecutor, Future
+from os import listdir, remove, replace
 from os.path import isfile, join, split
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
+from threading import Thread, Event
+from queue import Queue
 from cProfile import Profile
 from pstats import Stats
 from io import StringIO
-import pya
+from con_creator import encoder, fieldgrid, fieldorder, pec
+from con_creator.doses import DoseResolver
+from con_creator.deep import DeepShapes
+from con_creator import telemetry
+from con_creator.telemetry import Telemetry
+from con_creator.log import ListLog, WarningLog
+try:
+    import pya
+except ImportError:
+    import klayout.db as pya
+
+# Field sizes (um) and dots offered for each EBL, indices refer to defaults_*.ini
+FIELD_SIZES = {'cabl': [60, 120, 300, 600, 1200], 'xenos': [50, 100, 250, 500, 1000]}
+FIELD_DOTS = {'cabl': [10000, 20000, 60000, 240000], 'xenos': [50000]}
+# htrapezoids: horizontal trapezoid decomposition, best: the variant with fewest shots for every polygon
+FRACTURE_MODES = ('htrapezoids', 'best')
+SHOT_ORDERS = ('collected', 'hilbert')
+
+
+class Cancelled(Exception):
+    pass
 
 
 class Timer:
     def __init__(self):
         self.start, self.current = time(), time()
-        self.period = 0.1
-        self.last_update = self.start - self.period
-
-    def update(self):
-        self.current = time()
-        if self.current > self.last_update + self.period:
-            pya.QCoreApplication.processEvents()
-            self.last_update = self.current
 
     def refresh(self):
         self.start = time()
@@ -29,8 +48,81 @@ class Timer:
         return '---------------------------- %.1f seconds ----------------------------\n' % (self.current - self.start)
 
 
+class Field:
+    def __init__(self, size, dots, center):
+        self.size = size
+        self.dots = dots
+        self.center = center
+
+
+def sort_marks(ebl, marks):
+    # CABL expects the lower (or left) registration mark first
+    marks = list(marks)
+    if ebl == 'cabl':
+        if marks[0][1] > marks[1][1] or (marks[0][0] > marks[1][0] and marks[0][1] == marks[1][1]):
+            marks[0], marks[1] = marks[1], marks[0]
+    return marks
+
+
+class FieldIndex:
+    """
+    Grid hash of exposure fields. Without a field layer the fields themselves form the grid
+    anchored at the field center. Fields from a field layer are registered in every bucket
+    of a grid with the pitch of the largest field, so a lookup only checks neighbouring fields.
+    """
+
+    def __init__(self, size, center, ownfields=None):
+        self.size = size
+        self.center = center
+        self.ownfields = ownfields or []
+        self.boxes = {}
+        self.buckets = defaultdict(list)
+        if self.ownfields:
+            self.size = max(max(f.width(), f.height()) for f in self.ownfields)
+            for f in dict.fromkeys(self.ownfields):
+                for key in self.keys(f):
+                    self.buckets[key].append(f)
+
+    def key(self, x, y):
+        # grid indices of the bucket containing point (x, y)
+        return (int((x - self.center[0] - 0.5 * self.size) // self.size),
+                int((y - self.center[1] - 0.5 * self.size) // self.size))
+
+    def keys(self, box):
+        minkx, minky = self.key(box.left, box.bottom)
+        maxkx, maxky = self.key(box.right, box.top)
+        for kx in range(minkx, maxkx + 1):
+            for ky in range(minky, maxky + 1):
+                yield kx, ky
+
+    def box(self, key):
+        if key not in self.boxes:
+            x = int(self.center[0] + self.size * (key[0] + 0.5))
+            y = int(self.center[1] + self.size * (key[1] + 0.5))
+            self.boxes[key] = pya.Box(x, y, x + self.size, y + self.size)
+        return self.boxes[key]
+
+    def get_fields(self, bbox):
+        # return fields (list of pya.Box) sharing some area with bbox
+        if not self.ownfields:
+            return [f for f in map(self.box, self.keys(bbox)) if f.overlaps(bbox)]
+        fields = {}
+        for key in self.keys(bbox):
+            for f in self.buckets.get(key, ()):
+                if f.overlaps(bbox):
+                    fields[f] = None
+        return list(fields)
+
+
 class Calculus:
-    def __init__(self, ebl, dirname, field, marks, visible, direction, pitch, dose, outlog, field_layer, merge, bench=False):
+    # attributes passed to worker processes, everything needed for fracturing and emission of a field
+    emission_keys = ('ebl', 'dirname', 'field', 'marks', 'direction', 'pitch', 'dose', 'dbu', 'dist', 'squaredist',
+                     'end_bytes', 'vectorized', 'fracture_mode', 'shot_order')
+
+    def __init__(self, ebl, dirname, field, marks, visible, direction, pitch, dose, outlog, field_layer, merge,
+                 bench=False, processes=1, vectorized=True, reuse=False, incremental=False, fracture_mode='htrapezoids',
+                 optimize_grid=False, field_order='raster', shot_order='collected',
+                 proximity=None, deep=False):
         self.ebl = ebl
         self.dirname = dirname
         self.field = field
@@ -39,9 +131,8 @@ class Calculus:
         self.direction = direction
         self.pitch = pitch
         self.dose = dose
-        self.outlog = outlog
+        self.outlog = WarningLog(outlog)
         self.timer = Timer()
-        self.timer.update()
         self.dist = 0.001  # accuracy
         self.squaredist = self.dist ** 2
         self.end_bytes = bytes([0xff, 0xff, 0x13, 0x00] + 34 * [0xcc])
@@ -49,11 +140,68 @@ class Calculus:
         self.ownfields = []
         self.field_layer = field_layer
         self.merge = merge
+        self.processes = processes
+        self.queue_size = 4  # formatted fields waiting for the writer thread
+        self.vectorized = vectorized and encoder.np is not None
+        self.fracture_mode = fracture_mode
+        # the field center is moved to cut fewer shapes when there is no field layer
+        self.optimize_grid = optimize_grid and fieldgrid.np is not None
+        if optimize_grid and not self.optimize_grid:
+            self.outlog.write('Optimization of the field grid needs NumPy.\n')
+        # order of exposure, nearest falls back to serpentine without NumPy
+        self.field_order = field_order
+        if field_order == 'nearest' and fieldorder.np is None:
+            self.field_order = 'serpentine'
+            self.outlog.write('Nearest neighbour order of fields needs NumPy, serpentine order is used.\n')
+        self.written = []  # fields in order of writing
+        # proximity correction: (alpha, beta, eta) of the point spread function, ranges in um
+        self.proximity = proximity if pec.np is not None else None
+        if proximity is not None and self.proximity is None:
+            self.outlog.write('Proximity correction needs NumPy.\n')
+        self.corrector = None
+        # hilbert: shots of a field are grouped by dose and sorted along a Hilbert curve,
+        # Xenos current and pitch are written only when they change
+        self.shot_order = shot_order
+        # shapes are kept in a hierarchical copy of the layout and taken out field by field
+        self.deep = deep
+        # fractured cells are reused for instances inside one field, not possible for merged shapes
+        self.reuse = reuse and self.vectorized and not merge and proximity is None and not deep
+        if reuse and not self.reuse:
+            self.outlog.write('Reuse of fractured cells needs NumPy and is not used with merging, '
+                              'proximity correction or hierarchical collection.\n')
+        self.cells = {}  # (cell index, layer, dose) -> trapezoids of the cell as (dose, points, n)
+        self.placements = defaultdict(lambda: defaultdict(list))  # field -> cell key -> offsets
+        self.reused = 0
+        self.cell_shapes = {}  # cell key -> amount of shapes of the cell
+        self.reused_shapes = 0
+        # only fields whose digest differs from the previous conversion are fractured and written
+        self.incremental = incremental
+        self.previous = {}  # digest -> [field name, amount of trapezoids] of the previous conversion
+        self.digests = {}  # field name -> digest
+        self.amounts = {}
+        self.old_blocks = {}  # field name -> block of the previous .pat file
+        self.kept = 0
+        self.telemetry = Telemetry()
+        # conversion may run in a background thread: it is stopped by cancel() and reports progress
+        self.cancelled = Event()
+        self.progress = [0, 0]  # processed and all candidate fields
+        self.collected = 0  # flattened shapes, progress of the collection
+        self.source = None  # layout, cell and layers collected by run() when snapshot() did not collect them
+        self.polygons = None
+        self.parts = []  # output files written under temporary names
         # benchmarking
         if bench:
             self.pr = Profile()
             self.pr.enable()
 
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.emission_keys}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.outlog = ListLog()
+        self.telemetry = Telemetry()
+
     def print_stats(self):
         s = StringIO()
         sortby = 'cumulative'
@@ -62,123 +210,618 @@ class Calculus:
         self.outlog.write(s.getvalue())
 
     def start(self):
+        # Snapshot of layers shown in the current view, the conversion itself is done by run(). Only a copy
+        # of the layout is made here, shapes of the copy are collected by run() where they can be cancelled
         view = pya.Application.instance().main_window().current_view()
+        layers = []
         layit = view.begin_layers()
-        cell = view.active_cellview().cell
-        ly = view.active_cellview().layout()
+        while not layit.at_end():
+            lp = layit.current()
+            if ((lp.visible and self.visible) or not self.visible) and lp.valid:
+                layers.append(lp.layer_index())
+            layit.next()
+        ly = view.active_cellview().layout().dup()
+        self.snapshot(ly, ly.cell(view.active_cellview().cell.cell_index()), layers, collect=False)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise Cancelled('Conversion cancelled')
+
+    def convert(self, ly, cell, layers):
+        # Conversion of given layers (list of layer indices) of the cell, no GUI needed
+        self.snapshot(ly, cell, layers)
+        return self.run()
+
+    def snapshot(self, ly, cell, layers, collect=True):
+        """
+        Everything needed from the layout is copied here, run() does not touch the layout. The flat
+        snapshot holds every polygon of the chip until the end, only the deep one (DeepShapes) is hierarchical.
+        collect=False: the layout is not used by anybody else (a copy), its shapes are collected by run()
+        """
+        self.started = time()
+        # the log replaces the previous one only when the conversion succeeds
+        self.outlog.open(join(self.dirname, split(self.dirname)[1] + '.log'))
         self.dbu = ly.dbu
         self.field.size = int(self.field.size / self.dbu)
         self.field.center[0] = int(self.field.center[0] / self.dbu)
         self.field.center[1] = int(self.field.center[1] / self.dbu)
-        # Starting data collection from layers
+        self.source = ly, cell, layers
+        if collect:
+            self.collect_source()
+
+    def collect_source(self):
+        self.polygons = self.collect_polygons(*self.source)
+        self.source = None
+
+    def run(self):
+        # Division, clipping, fracturing and writing of the snapshot, may run in a background thread
+        succeeded = False
+        try:
+            if self.polygons is None:
+                self.collect_source()
+            polygons = self.polygons
+            self.check_cancelled()
+            with self.telemetry.stage('division'):
+                fields, shapes, buckets = self.polygon_division(polygons)
+            if self.proximity is not None:
+                with self.telemetry.stage('pec'):
+                    self.corrector = pec.Corrector(*self.proximity, dbu=self.dbu)
+                    if isinstance(shapes, DeepShapes):
+                        groups = shapes.regions(self.dose)
+                    else:
+                        groups = pec.Corrector.group(shapes, self.dose, self.check_cancelled)
+                    self.corrector.build(groups, self.check_cancelled)
+            self.outlog.write(str(self.timer))
+            self.progress = [0, len(fields)]
+            clipped = self.clipped_fields(fields, shapes, buckets)
+            if self.ebl == 'cabl':
+                amount, nfields = self.write_files(clipped)
+            elif self.ebl == 'xenos':
+                amount, nfields = self.write_pat_ctl(clipped)
+            self.outlog.write('There were ', len(polygons), ' polygons. Now there are ', amount,
+                              ' polygons in ', nfields, ' fields.\n')
+            self.report_travel()
+            if self.corrector is not None:
+                self.outlog.write(self.corrector.summary(), '.\n')
+            if self.incremental:
+                self.outlog.write(self.kept, ' of ', nfields, ' fields are unchanged.\n')
+            self.telemetry.count('reused instances', self.reused)
+            self.telemetry.count('fields', nfields)
+            self.telemetry.count('unchanged fields', self.kept)
+            if self.fracture_mode == 'best':
+                counts = self.telemetry.counts
+                self.outlog.write('Fracturing with fewest shots saved ', counts.get('shots saved', 0),
+                                  ' shots and avoided ', counts.get('collapses avoided', 0), ' collapsed pieces in ',
+                                  counts.get('fields with fewer shots', 0), ' fields.\n')
+            self.save_telemetry()
+            self.outlog.write(self.telemetry.summary(), '\n')
+            self.outlog.write(str(self.timer))
+            self.outlog.write('End of writing files.\n')
+
+            # end of benchmarking
+            if self.bench:
+                self.pr.disable()
+                self.print_stats()
+            succeeded = True
+        finally:
+            self.outlog.summary()
+            self.outlog.close(succeeded)
+        return True
+
+    def collect_polygons(self, ly, cell, layers):
+        # (dose, polygon) of all shapes outside of the field layer. Fields have to be known before
+        # instances are placed, so the field layer is read first and the field index is built here
         self.outlog.write('Collecting data from layers:\n')
         polygons = []
-        while not layit.at_end():
-            lp = layit.current()
-            info = ly.get_info(lp.layer_index())
-            name_type = str(info.layer) + '/' + str(info.datatype)
-            if ((lp.visible and self.visible) or not self.visible) and lp.valid:
-                self.outlog.write(info, '\n')
-                shape_iter = ly.begin_shapes(cell, lp.layer_index())
-                while not shape_iter.at_end():
-                    shape = shape_iter.shape()
-                    poly = shape.polygon.transformed(shape_iter.itrans())
-                    if name_type != self.field_layer:
-                        d = shape.property('dose')
-                        # If shape's dose is None, look for closest instance dose in instance path
-                        if d is None:
-                            instpath = pya.ObjectInstPath(shape_iter, view.active_cellview_index())
-                            # Using deepest dose in instance hierarchy
-                            for i in instpath.each_inst():
-                                if i.inst().property('dose') is not None:
-                                    d = i.inst().property('dose')
-                        polygons.append((float(d) if d is not None else None, poly))
-                    elif name_type == self.field_layer:
-                        if not poly.is_box():
-                            self.outlog.write('There is a non-box shape on a field layer.\n')
-                            shape_iter.next()
-                            continue
+        resolver = DoseResolver()
+        names = {}
+        for layer_index in layers:
+            info = ly.get_info(layer_index)
+            names[layer_index] = str(info.layer) + '/' + str(info.datatype)
+            if names[layer_index] != self.field_layer:
+                continue
+            self.outlog.write(info, '\n')
+            with self.telemetry.stage('collect', layer=names[layer_index]):
+                for dose, poly in resolver.each_polygon(cell, layer_index):
+                    if not poly.is_box():
+                        self.outlog.write('There is a non-box shape on a field layer.\n')
+                    else:
                         self.ownfields.append(poly.bbox())
-                    shape_iter.next()
-            self.timer.update()
-            layit.next()
+        if self.optimize_grid and not self.ownfields:
+            with self.telemetry.stage('grid'):
+                self.place_grid(cell, [l for l in layers if names[l] != self.field_layer])
+        self.field_index = FieldIndex(self.field.size, self.field.center, self.ownfields)
+        if self.deep:
+            return self.collect_deep(ly, cell, [l for l in layers if names[l] != self.field_layer], names, resolver)
+        for layer_index in layers:
+            if names[layer_index] == self.field_layer:
+                continue
+            self.outlog.write(ly.get_info(layer_index), '\n')
+            place = self.placer(resolver, layer_index) if self.reuse else None
+            before = len(polygons) + self.reused_shapes
+            with self.telemetry.stage('collect', layer=names[layer_index]):
+                shapes = resolver.each_polygon(cell, layer_index, place=place)
+                while True:
+                    chunk = list(islice(shapes, 1 << 16))
+                    if not chunk:
+                        break
+                    polygons.extend(chunk)
+                    self.collected = len(polygons)
+                    self.check_cancelled()
+            self.telemetry.count('shapes', len(polygons) + self.reused_shapes - before, layer=names[layer_index])
+        if self.reuse:
+            self.outlog.write(self.reused, ' instances of ', len(self.cells), ' cells reuse fractured shapes.\n')
+        return polygons
 
-        self.timer.update()
-        shapes_with_f, amount = self.polygon_division(polygons)
-        self.outlog.write(str(self.timer))
-        self.outlog.write('There were ', len(polygons), ' polygons. Now there are ', amount,
-                          ' polygons in ', len(shapes_with_f.keys()), ' fields.\n')
-        self.timer.update()
-        if self.ebl == 'cabl':
-            self.write_files(shapes_with_f)
-        elif self.ebl == 'xenos':
-            self.write_pat_ctl(shapes_with_f)
-        self.outlog.write(str(self.timer))
-        self.outlog.write('End of writing files.\n')
-
-        # end of benchmarking
-        if self.bench:
-            self.pr.disable()
-            self.print_stats()
-        return True
+    def collect_deep(self, ly, cell, layers, names, resolver):
+        # shapes of all layers copied hierarchically, nothing is flattened here
+        for layer_index in layers:
+            self.outlog.write(ly.get_info(layer_index), '\n')
+        self.check_cancelled()
+        with self.telemetry.stage('collect'):
+            shapes = DeepShapes(ly, cell, layers, resolver)
+        for layer_index in layers:
+            self.telemetry.count('shapes', shapes.counts.get(layer_index, 0), layer=names[layer_index])
+        self.telemetry.count('cell variants', len(shapes.variants))
+        return shapes
 
-    def get_fields(self, shape):
-        # return fields (list of pya.Box) where the shape is located
-        minimx = int(self.field.center[0] + self.field.size *
-                     ((shape.bbox().left - self.field.center[0] - 0.5 * self.field.size) // self.field.size + 0.5))
-        maximx = int(self.field.center[0] + self.field.size *
-                     ((shape.bbox().right - self.field.center[0] - 0.5 * self.field.size) // self.field.size + 0.5))
-        minimy = int(self.field.center[1] + self.field.size *
-                     ((shape.bbox().bottom - self.field.center[1] - 0.5 * self.field.size) // self.field.size + 0.5))
-        maximy = int(self.field.center[1] + self.field.size *
-                     ((shape.bbox().top - self.field.center[1] - 0.5 * self.field.size) // self.field.size + 0.5))
-        fields = []
-        for x in range(minimx, maximx + 1, self.field.size):
-            for y in range(minimy, maximy + 1, self.field.size):
-                fields.append(pya.Box(x, y, x + self.field.size, y + self.field.size))
-        return fields
+    def place_grid(self, cell, layers):
+        # Field center with fewest cut shapes and occupied fields, found from bounding boxes of all shapes
+        coords = array('q')
+        for layer_index in layers:
+            it = cell.begin_shapes_rec(layer_index)
+            while not it.at_end():
+                if not it.shape().is_text():
+                    b = it.shape().bbox().transformed(it.trans())
+                    coords.extend((b.left, b.bottom, b.right, b.top))
+                it.next()
+        boxes = fieldgrid.np.frombuffer(coords, dtype=fieldgrid.np.int64).reshape(-1, 4).T
+        center, before, after = fieldgrid.optimize(boxes, self.field.size, self.field.center)
+        self.field.center = center
+        self.outlog.write('Field center: (', round(center[0] * self.dbu, 3), ', ', round(center[1] * self.dbu, 3),
+                          ') um, ', after[0], ' cut shapes in ', after[1], ' fields instead of ', before[0],
+                          ' in ', before[1], '.\n')
+
+    def report_travel(self):
+        # estimated stage travel between centers of written fields, compared with the raster order
+        path = fieldorder.travel(self.written) * self.dbu / 1000
+        self.telemetry.count('stage travel mm', round(path, 3))
+        message = ['Stage travel: ', round(path, 3), ' mm']
+        if self.field_order != 'raster':
+            message += [' in ', self.field_order, ' order, ',
+                        round(fieldorder.travel(fieldorder.raster(self.written)) * self.dbu / 1000, 3), ' mm in raster']
+        self.outlog.write(*message, '.\n')
 
     def polygon_division(self, shapes):
-        # Firstly all shapes are split into parts according to field boarders
-        shapes_fielded = defaultdict(list)
-        sections = []
-        if self.field_layer == '':
-            new_sections = []
+        """
+        Shapes are bucketed to the fields they overlap, only bounding boxes are used here.
+        Returns fields in order of writing, shapes and indices of shapes in every field
+        together with flag whether the shape lies entirely inside the field.
+        Hierarchically collected shapes only give occupied fields, they have no buckets
+        """
+        if isinstance(shapes, DeepShapes):
+            return fieldorder.order(shapes.fields(self.field_index), self.field_order), shapes, None
+        if self.merge:
+            # Shapes of equal dose are merged once, afterwards merged polygons are clipped as usual
+            groups = defaultdict(pya.Region)
             for dose, shape in shapes:
-                sections.extend(self.get_fields(shape))
-            for sec in sections:
-                if sec not in new_sections:
-                    new_sections.append(sec)
-            sections = new_sections
-        else:
-            sections = self.ownfields
-
-        for sec in sections:
-            if self.merge:
-                if shapes_fielded[sec] == []:
-                    shapes_fielded[sec] = [[self.dose, []]]
-                shapes_fielded[sec][0][1].extend(
-                    pya.EdgeProcessor().boolean_p2p([s for _, s in shapes], [sec], pya.EdgeProcessor.ModeAnd, True, True))
+                groups[dose if dose is not None else self.dose].insert(shape)
+            shapes = []
+            for dose, region in groups.items():
+                region.min_coherence = True
+                shapes.extend((dose, poly) for poly in region.merged().each())
+
+        buckets = defaultdict(list)
+        for i, (dose, shape) in enumerate(shapes):
+            if not i & 0xffff:
+                self.check_cancelled()
+            bbox = shape.bbox()
+            for sec in self.field_index.get_fields(bbox):
+                buckets[sec].append((i, bbox.inside(sec)))
+        fields = set(buckets) | set(self.placements)
+        return fieldorder.order(fields, self.field_order), shapes, buckets
+
+    def placer(self, resolver, layer):
+        """
+        Callback for DoseResolver.each_polygon: instances which are only shifted and lie inside
+        one field are not flattened. Their cell is fractured once and the field gets its offset.
+        """
+        def place(cell, trans, dose):
+            if trans.is_mag() or trans.is_mirror() or trans.angle != 0:
+                return False
+            bbox = cell.bbox_per_layer(layer).moved(trans.disp)
+            fields = self.field_index.get_fields(bbox)
+            if len(fields) != 1 or not bbox.inside(fields[0]):
+                return False
+            key = (cell.cell_index(), layer, dose)
+            if key not in self.cells:
+                self.cells[key] = self.cell_blocks(resolver, cell, layer, dose)
+            if self.cells[key] is None:
+                return False
+            self.placements[fields[0]][key].append((trans.disp.x, trans.disp.y))
+            self.reused += 1
+            self.reused_shapes += self.cell_shapes[key]
+            return True
+        return place
+
+    def cell_blocks(self, resolver, cell, layer, dose):
+        # Trapezoids of the cell in its own coordinates grouped by dose as (dose, points, n)
+        groups = defaultdict(list)
+        for d, poly in resolver.each_polygon(cell, layer, dose=dose):
+            groups[d if d is not None else self.dose].append(poly)
+        self.cell_shapes[(cell.cell_index(), layer, dose)] = sum(len(polys) for polys in groups.values())
+        blocks = []
+        for d, polys in groups.items():
+            points = encoder.trapezoid_points(self.fracture_field([(d, polys)], None)[0][0][1])
+            if points is None:
+                return None
+            blocks.append((d,) + points)
+        return blocks
+
+    def clipped_fields(self, fields, shapes, buckets):
+        """
+        Generator of non-empty fields with shapes split according to field boarders, one field at a time.
+        Yields field, list of [dose, polygons] and reused cells as list of (cell blocks, offsets)
+        """
+        nfields = 0
+        for sec in fields:
+            with self.telemetry.stage('clip') as labels:
+                if buckets is None:
+                    shapes_fielded = shapes.field(sec, self.dose, self.merge)
+                else:
+                    shapes_fielded = self.clip(sec, shapes, buckets.pop(sec, ()))
+                if self.corrector is not None and shapes_fielded:
+                    # doses are corrected per trapezoid, the writers fracture trapezoids into themselves
+                    fractured, saved, avoided = self.fracture_field(shapes_fielded, sec)
+                    self.fracture_saving(self.field_name(nfields), saved, avoided)
+                    shapes_fielded = self.corrector.apply(fractured)
+                placed = [(self.cells[key], encoder.np.array(offsets, dtype=encoder.np.int64))
+                          for key, offsets in self.placements.pop(sec, {}).items()]
+                if shapes_fielded or placed:
+                    labels['field'] = self.field_name(nfields)
+            self.progress[0] += 1
+            if shapes_fielded or placed:
+                nfields += 1
+                yield sec, shapes_fielded, placed
+
+    def clip(self, sec, shapes, bucket):
+        # [dose, polygons] of bucketed shapes clipped to the field
+        shapes_fielded = []
+        for i, inside in bucket:
+            dose, shape = shapes[i]
+            dose = dose if dose is not None else self.dose
+            # Shapes lying entirely inside the field need no clipping
+            if inside:
+                polys = [shape]
+            else:
+                polys = pya.EdgeProcessor().boolean_p2p([shape], [sec], pya.EdgeProcessor.ModeAnd, True, True)
+            if not polys:
+                continue
+            if self.merge and shapes_fielded and shapes_fielded[-1][0] == dose:
+                shapes_fielded[-1][1].extend(polys)
+            else:
+                shapes_fielded.append([dose, polys])
+        return shapes_fielded
+
+    @staticmethod
+    def fracture(polys):
+        # Clipped shapes are divided into trapezoids, parallelograms and triangles
+        trs = []
+        for poly in polys:
+            trs.extend(poly.decompose_trapezoids(pya.Polygon.TD_htrapezoids))
+        return trs
+
+    def fracture_field(self, shapes, field):
+        """
+        Trapezoids of every (dose, polygons) entry of a field according to the fracture mode.
+        Returns list of (dose, trapezoids), amount of saved shots and of avoided collapsed pieces
+        compared to the horizontal trapezoid decomposition
+        """
+        if self.fracture_mode != 'best':
+            return [(dose, self.fracture(polys)) for dose, polys in shapes], 0, 0
+        fractured, saved, avoided = [], 0, 0
+        for dose, polys in shapes:
+            trs = []
+            for poly in polys:
+                candidates = self.fracture_candidates(poly)
+                scores = [(self.count_collapsed(pieces, field), len(pieces)) for pieces in candidates]
+                best = min(range(len(candidates)), key=scores.__getitem__)
+                trs.extend(candidates[best])
+                saved += scores[0][1] - scores[best][1]
+                avoided += scores[0][0] - scores[best][0]
+            fractured.append((dose, trs))
+        return fractured, saved, avoided
+
+    @staticmethod
+    def fracture_candidates(poly):
+        """
+        Decompositions of the polygon the writers can handle, horizontal trapezoids first.
+        Vertical trapezoids are not offered: both formats describe trapezoids by horizontal edges
+        """
+        candidates = [poly.decompose_trapezoids(pya.Polygon.TD_htrapezoids)]
+        if poly.num_points() <= 4:
+            return candidates
+        candidates.append(poly.decompose_trapezoids(pya.Polygon.TD_simple))
+        if poly.is_rectilinear():
+            # rectangles of convex decompositions
+            for orientation in (pya.Polygon.PO_any, pya.Polygon.PO_horizontal, pya.Polygon.PO_vertical):
+                pieces = poly.decompose_convex(orientation)
+                if all(p.num_points() <= 4 for p in pieces):
+                    candidates.append(pieces)
+        return candidates
+
+    def count_collapsed(self, pieces, field):
+        # amount of pieces the writer drops as collapsed in field coordinates, nothing collapses without a field
+        if field is None:
+            return 0
+        coef = self.field.dots / self.field.size
+        n = 0
+        for tr in pieces:
+            if self.ebl == 'cabl':
+                points = [(int((p.x - field.left) * coef), int((field.top - p.y) * coef)) for p in tr.each_point()]
+            else:
+                points = [(int((p.x - field.left) * coef), int((p.y - field.bottom) * coef)) for p in tr.each_point()]
+            if self.collapse_reason(points + points[:1]) is not None:
+                n += 1
+        return n
+
+    def fracture_saving(self, name, saved, avoided):
+        # counted per field, run() writes the totals in one line
+        if self.fracture_mode != 'best':
+            return
+        self.telemetry.count('shots saved', saved, field=name)
+        self.telemetry.count('collapses avoided', avoided, field=name)
+        if saved or avoided:
+            self.telemetry.count('fields with fewer shots')
+
+    def field_name(self, i):
+        return 'field_' + str(i + 1) if self.ebl == 'cabl' else 'field' + str(i)
+
+    def emit_fields(self, clipped):
+        # Fractured and formatted fields as (field, name, contents), computed by a pool of processes if requested
+        emit = self.emit_cabl if self.ebl == 'cabl' else self.emit_xenos
+        named = ((f, self.field_name(i), shapes, placed) for i, (f, shapes, placed) in enumerate(clipped))
+        if self.processes <= 1:
+            for f, name, shapes, placed in named:
+                result = self.unchanged(f, name, shapes, placed)
+                yield f, name, emit(f, name, shapes, placed) if result is None else result
+            return
+        with ProcessPoolExecutor(self.processes, initializer=init_worker, initargs=(self.__getstate__(),)) as pool:
+            # a few fields per process are in flight, the rest is not clipped yet
+            pending = deque()
+            for f, name, shapes, placed in named:
+                result = self.unchanged(f, name, shapes, placed)
+                if result is not None:
+                    pending.append((f, name, done(([], None, result))))
+                    continue
+                task = ((f.left, f.bottom, f.right, f.top), name, [(dose, pack_polygons(polys)) for dose, polys in shapes],
+                        placed)
+                pending.append((f, name, pool.submit(emit_packed, task)))
+                if len(pending) >= 2 * self.processes:
+                    yield self.collect(*pending.popleft())
+            while pending:
+                yield self.collect(*pending.popleft())
+
+    def field_digest(self, f, shapes, placed):
+        # Digest of everything written for a field except its name: parameters, box, clipped shapes and reused
+        # cells. Fields keep their digests when other fields are added, removed or reordered
+        digest = sha1(repr((self.ebl, self.field.size, self.field.dots, self.pitch, self.direction, self.dbu,
+                            self.fracture_mode, self.shot_order, (f.left, f.bottom, f.right, f.top))).encode())
+        for dose, polys in shapes:
+            digest.update(repr(dose).encode())
+            digest.update(pack_polygons(polys).tobytes())
+        for cell_blocks, offsets in placed:
+            for dose, points, n in cell_blocks:
+                digest.update(repr(dose).encode())
+                digest.update(points.tobytes())
+                digest.update(n.tobytes())
+            digest.update(offsets.tobytes())
+        return digest.hexdigest()
+
+    def unchanged(self, f, name, shapes, placed):
+        # Result of a field kept from the previous conversion, None if the field has to be emitted
+        if not self.incremental:
+            return None
+        self.digests[name] = self.field_digest(f, shapes, placed)
+        if self.digests[name] not in self.previous:
+            return None
+        old, amount = self.previous[self.digests[name]]
+        if self.ebl == 'cabl':
+            if not (isfile(join(self.dirname, old + '.ccc')) and isfile(join(self.dirname, old + '.cbc'))):
+                return None
+            if old == name:
+                result = None, None, amount
             else:
-                for i, (dose, shape) in enumerate(shapes):
-                    shapes_fielded[sec].append([dose if dose is not None else self.dose, []])
-                    shapes_fielded[sec][i][1].extend(
-                        pya.EdgeProcessor().boolean_p2p([shape], [sec], pya.EdgeProcessor.ModeAnd, True, True))
-            shapes_fielded[sec] = [[dose, polys] for dose, polys in shapes_fielded[sec] if polys != []]
-            if not shapes_fielded[sec]:
-                shapes_fielded.pop(sec, None)
-
-        # Secondly new shapes are divided into trapezoids, parallelograms and triangles
-        amount = 0
-        for field in shapes_fielded.keys():
-            for i, (dose, polys) in enumerate(shapes_fielded[field]):
-                trs = []
-                for poly in polys:
-                    trs.extend(poly.decompose_trapezoids(pya.Polygon.TD_htrapezoids))
-                shapes_fielded[field][i][1] = trs
-                amount += len(trs)
-
-        return shapes_fielded, amount
+                # the field got another name, files of the old one are written again with the new name
+                with open(join(self.dirname, old + '.ccc')) as fccc:
+                    ccc = fccc.read().split('\n', 1)[1]
+                with open(join(self.dirname, old + '.cbc'), 'rb') as fcbc:
+                    cbc = fcbc.read()[len(self.cbc_caption(old)):]
+                result = self.ccc_caption(name) + ccc, self.cbc_caption(name) + cbc, amount
+        elif old in self.old_blocks:
+            result = 'D ' + name + '\n' + self.old_blocks[old].split('\n', 1)[1], amount
+        else:
+            return None
+        self.kept += 1
+        return result
+
+    def save_telemetry(self):
+        # Report of the run next to the output files, also passed to hooks of external collectors
+        report = self.telemetry.report(
+            ebl=self.ebl, started=self.started, wall=time() - self.started, field_size=self.field.size * self.dbu,
+            field_dots=self.field.dots, pitch=self.pitch, dose=self.dose, merge=self.merge,
+            processes=self.processes, vectorized=self.vectorized, reuse=self.reuse, incremental=self.incremental,
+            field_order=self.field_order)
+        with open(join(self.dirname, split(self.dirname)[1] + '.telemetry.json'), 'w') as f:
+            json.dump(report, f, indent=1)
+        for hook in telemetry.hooks:
+            try:
+                hook(report)
+            except Exception as e:
+                self.outlog.write('Telemetry hook failed: ', repr(e), '\n')
+
+    def manifest_path(self):
+        return join(self.dirname, split(self.dirname)[1] + '.fields.json')
+
+    def load_manifest(self):
+        # Digests of the previous conversion
+        if not self.incremental:
+            return
+        path = self.manifest_path()
+        try:
+            with open(path) as f:
+                self.previous = json.load(f)['digests']
+        except (OSError, ValueError, KeyError):
+            self.previous = {}
+
+    def save_manifest(self):
+        # digests of the committed output, a full conversion removes them
+        path = self.manifest_path()
+        if not self.incremental:
+            if isfile(path):
+                remove(path)
+            return
+        digests = {digest: [name, self.amounts[name]] for name, digest in self.digests.items()}
+        with open(path + '.part', 'w') as f:
+            json.dump({'digests': digests}, f, indent=1)
+        replace(path + '.part', path)
+
+    def part(self, name):
+        # Path of a temporary output file, renamed to name when the conversion succeeds
+        self.parts.append(name)
+        return join(self.dirname, name + '.part')
+
+    def commit_parts(self, extensions, keep):
+        # Stale outputs (extensions, except files in keep) are removed and new files take their names
+        self.remove_files(extensions, keep)
+        for name in self.parts:
+            replace(join(self.dirname, name + '.part'), join(self.dirname, name))
+        self.parts = []
+        self.save_manifest()
+
+    def discard_parts(self):
+        for name in self.parts:
+            path = join(self.dirname, name + '.part')
+            if isfile(path):
+                remove(path)
+        self.parts = []
+
+    def remove_files(self, extensions, keep=()):
+        # Removes files with given extensions from the output directory except files named in keep
+        for item in listdir(self.dirname):
+            path = join(self.dirname, item)
+            if isfile(path) and item not in keep:
+                end = split(item)[-1].lower()
+                if len(end) > 3 and end[-3:] in extensions:
+                    remove(path)
+
+    def collect(self, f, name, future):
+        messages, snapshot, result = future.result()
+        for method, args in messages:
+            getattr(self.outlog, method)(*args)
+        if snapshot is not None:
+            self.telemetry.merge(snapshot)
+        return f, name, result
+
+    def stream(self, clipped, write):
+        """
+        Fields are clipped, fractured and formatted in this thread, while a writer thread calls
+        write(field, name, contents). The queue between them holds a few fields only, so memory of the output
+        side follows the largest fields; the snapshot of the input stays in memory next to it.
+        Returns amount of trapezoids and fields
+        """
+        results = Queue(self.queue_size)
+        errors = []
+
+        def writer():
+            while True:
+                item = results.get()
+                if item is None:
+                    return
+                if not errors:
+                    try:
+                        with self.telemetry.stage('write', field=item[1]):
+                            write(*item)
+                    except Exception as e:
+                        errors.append(e)
+
+        thread = Thread(target=writer, daemon=True)
+        thread.start()
+        amount, nfields = 0, 0
+        try:
+            for f, name, result in self.emit_fields(clipped):
+                self.check_cancelled()
+                if errors:
+                    break
+                results.put((f, name, result))
+                self.written.append(f)
+                self.amounts[name] = result[-1]
+                amount += result[-1]
+                nfields += 1
+        finally:
+            results.put(None)
+            thread.join()
+        if errors:
+            raise errors[0]
+        return amount, nfields
+
+    def collapsed(self, raw, reason, points=None):
+        # raw: points of the trapezoid in database units
+        if points is not None:
+            # message of the baseline writer, without a line break
+            self.outlog.warn(reason, 'Polygon collapsed by ' + reason + '. Points: ', points)
+        else:
+            self.outlog.warn(reason, 'Polygon collapsed due to ' + reason + '. Points: [',
+                             ', '.join('(%.3f, %.3f)' % (x * self.dbu, y * self.dbu) for x, y in raw) + ']\n')
+
+    @staticmethod
+    def raw_points(shape):
+        return [(p.x, p.y) for p in shape.each_point()]
+
+    def blocks(self, fractured, placed):
+        # Trapezoids of a field for the encoder as (dose, points, n), None if the scalar writers are needed
+        if not self.vectorized:
+            return None
+        blocks = []
+        for dose, trs in fractured:
+            points = encoder.trapezoid_points(trs)
+            if points is None:
+                return None
+            blocks.append((dose,) + points)
+        return blocks + encoder.placed_blocks(placed)
+
+    @staticmethod
+    def placed_trapezoids(placed):
+        # Trapezoids of reused cells as polygons for the scalar writers
+        return [(dose, [pya.SimplePolygon([pya.Point(x, y) for x, y in p[:k].tolist()], True)
+                        for p, k in zip(points, n.tolist())])
+                for dose, points, n in encoder.placed_blocks(placed)]
+
+    def hilbert_bits(self):
+        # bits of the Hilbert curve through all dots of a field for the hilbert shot order, 0 keeps the collected order
+        return encoder.hilbert_bits(self.field.dots) if self.shot_order == 'hilbert' else 0
+
+    def shots(self, fractured, field, flip):
+        """
+        (dose, trapezoid) in order of emission for the scalar writers, the same order as
+        encoder.shot_order for the hilbert shot order
+        """
+        shots = [(dose, shape) for dose, trs in fractured for shape in trs]
+        if self.shot_order != 'hilbert':
+            return shots
+        coef = self.field.dots / self.field.size
+        bits = self.hilbert_bits()
+
+        def key(shot):
+            xs, ys = [], []
+            for p in shot[1].each_point():
+                xs.append(int((p.x - field.left) * coef))
+                ys.append(int((field.top - p.y) * coef if flip else (p.y - field.bottom) * coef))
+            return shot[0], encoder.hilbert_index((min(xs) + max(xs)) // 2, (min(ys) + max(ys)) // 2, bits)
+        return sorted(shots, key=key)
 
     @staticmethod
     def signed_area(points):
@@ -189,6 +832,31 @@ class Calculus:
             p1 = p2
         return area
 
+    @staticmethod
+    def writer_order(points, area, reverse_positive):
+        # closed points starting from the lowest one (smallest y, then x), reversed depending on the sign of the area
+        min_index, min_value = min(enumerate(points), key=lambda p: (p[1][1], p[1][0]))
+        points = points[min_index:] + points[1:min_index + 1]
+        if area > 0 if reverse_positive else area < 0:
+            points = points[::-1]
+        return points
+
+    def collapse_reason(self, points):
+        """
+        Reason why get_str_bin or get_str_pat drops the polygon, None if it is written.
+        points: closed list of points in field coordinates
+        """
+        if len(points) < 4:
+            return 'amount of points'
+        area = self.signed_area(points)
+        if area == 0:
+            return 'zero area'
+        if self.ebl == 'cabl':
+            points = self.writer_order(points, area, False)
+            if points[1][1] == points[0][1]:
+                return 'ZeroDivisionError'
+        return None
+
     def get_str_bin(self, shape, field, dose):
         coef = self.field.dots / self.field.size
         points = []
@@ -199,17 +867,12 @@ class Calculus:
         points.append(points[0])
         area = self.signed_area(points)
         if len(points) < 4:
-            self.outlog.write('Polygon collapsed due to amount of points. Points: [',
-                ', '.join('(%.3f, %.3f)' % (v.x * self.dbu, v.y * self.dbu) for v in shape.each_point()) + ']\n')
+            self.collapsed(self.raw_points(shape), 'amount of points')
             return None, None, None
         elif area == 0:
-            self.outlog.write('Polygon collapsed due to zero area. Points: [',
-                ', '.join('(%.3f, %.3f)' % (v.x * self.dbu, v.y * self.dbu) for v in shape.each_point()) + ']\n')
+            self.collapsed(self.raw_points(shape), 'zero area')
             return None, None, None
-        min_index, min_value = min(enumerate(points), key=lambda p: (p[1][1], p[1][0]))
-        points = points[min_index:] + points[1:min_index + 1]
-        if area < 0:
-            points = points[::-1]  # reverse
+        points = self.writer_order(points, area, False)
 
         # next level japanese logic here
         outbinary = [0] * 8
@@ -225,7 +888,7 @@ class Calculus:
             if points[2][1] != points[1][1]:
                 outbinary[5] = (1 - outbinary[2]) / outbinary[6]
         except ZeroDivisionError:
-            self.outlog.write('Polygon collapsed by ZeroDivisionError. Points: ', points)
+            self.collapsed(self.raw_points(shape), 'ZeroDivisionError', points)
             return None, None, None
         outbinary[6] += 1
         outbinary[4] = self.pitch  # maybe pitch
@@ -248,56 +911,96 @@ class Calculus:
         return outstr, poly_type, bytes([0x01, 0x08, 0x13, 0x00]) + bytes(self.direction, 'utf-8') + \
             bytes([0x00]) + bytes(packed_data)
 
-    def write_files(self, shapes_with_f):
-        for item in listdir(self.dirname):
-            path = join(self.dirname, item)
-            if isfile(path):
-                end = split(item)[-1].lower()
-                if len(end) > 3:
-                    if end[-3:] == 'con' or end[-3:] == 'ccc' or end[-3:] == 'cbc':
-                        remove(path)
+    def write_files(self, clipped):
+        # files of unchanged fields are kept, stale ones are removed after writing
+        self.load_manifest()
         filename = split(self.dirname)[1] + '.con'
-        fcon = open(join(self.dirname, filename), 'w')
+        fcon = open(self.part(filename), 'w')
         fcon.write('/*--- ' + filename + ' ---*/\n')
         cz = 'CZ' + str(round(self.field.size * self.dbu / 1000, 6)) + ',' + str(self.field.dots)
         fcon.write(cz + ';\n')
         if self.marks is not None:
             fcon.write('R2 ' + str(self.marks[0][0]) + ',' + str(self.marks[0][1]) + '; ' +
                        str(self.marks[1][0]) + ',' + str(self.marks[1][1]) + ';\n')
-        fields = sorted(shapes_with_f.keys(), key=lambda f: (f.bottom, f.left))
-        fname = 'field'
-        for i, f in enumerate(fields):
-            if i % 20 == 0:
-                self.timer.update()
+
+        def write(f, name, result):
+            ccc, cbc, _ = result
             a = str(round((f.left + f.right) / 2 * self.dbu / 1000, 6))
             b = str(round((f.top + f.bottom) / 2 * self.dbu / 1000, 6))
-            fcon.write('PC' + fname + '_' + str(i + 1) + ';\n' + a + ',' + b + ';\n')
-            fcon.write('PP' + fname + '_' + str(i + 1) + ';\n' + a + ',' + b + ';\n')
-
-            fccc_name = fname + '_' + str(i + 1) + '.ccc'
-            fccc = open(join(self.dirname, fccc_name), 'w')
-            fccc.write('/*--- ' + fccc_name + ' ---*/\n')
-            fccc.write('/* ' + cz + ' */\n')
-            fccc.write('PATTERN\n')
-
-            fcbc_name = fname + '_' + str(i + 1) + '.cbc'
-            amount_cc = 24 - len(fcbc_name)  # amount of 0xcc needed after caption
-            fcbc = open(join(self.dirname, fcbc_name), 'wb')
-            fcbc.write(bytes(fcbc_name + ';1.1;', 'utf-8') + bytes([0x00]) + bytes(amount_cc * [0xcc]))
-            for dose, shapes in shapes_with_f[f]:
-                for shape in shapes:
-                    string, poly_type, binary = self.get_str_bin(shape, f, dose)
-                    if poly_type is not None:
-                        fccc.write(poly_type + '(' + string + str(self.pitch) + ',' + str(dose) + ');3\n')
-                        fcbc.write(binary)
-            fccc.write('!END\n')
-            fccc.close()
-            fcbc.write(self.end_bytes)
-            fcbc.close()
-        fcon.write('!END\n')
+            fcon.write('PC' + name + ';\n' + a + ',' + b + ';\n')
+            fcon.write('PP' + name + ';\n' + a + ',' + b + ';\n')
+            if ccc is None:
+                return
+            with open(self.part(name + '.ccc'), 'w') as fccc:
+                fccc.write(ccc)
+            with open(self.part(name + '.cbc'), 'wb') as fcbc:
+                fcbc.write(cbc)
+
+        try:
+            counts = self.stream(clipped, write)
+            fcon.write('!END\n')
+        except BaseException:
+            fcon.close()
+            self.discard_parts()
+            raise
         fcon.close()
+        self.commit_parts(('con', 'ccc', 'cbc'), [filename] + [name + end for name in self.amounts
+                                                             for end in ('.ccc', '.cbc')])
+        return counts
 
-    def get_str_pat(self, shape, field, dose):
+    def emit_cabl(self, field, name, shapes, placed=()):
+        # Contents of .ccc and .cbc files of one field and amount of trapezoids
+        cz = 'CZ' + str(round(self.field.size * self.dbu / 1000, 6)) + ',' + str(self.field.dots)
+        ccc = [self.ccc_caption(name), '/* ' + cz + ' */\n', 'PATTERN\n']
+        cbc = [self.cbc_caption(name)]
+        with self.telemetry.stage('fracture', field=name):
+            fractured, saved, avoided = self.fracture_field(shapes, field)
+        self.fracture_saving(name, saved, avoided)
+        with self.telemetry.stage('emit', field=name):
+            blocks = self.blocks(fractured, placed)
+            encoded = None
+            if blocks is not None:
+                encoded = encoder.encode_cabl(blocks, field, self.field.dots / self.field.size, self.pitch,
+                                              self.direction, self.hilbert_bits())
+            if encoded is not None:
+                lines, records, collapsed = encoded
+                for raw, reason, points in collapsed:
+                    self.collapsed(raw, reason, points)
+                ccc.extend(lines)
+                cbc.append(records)
+                ncollapsed = len(collapsed)
+            else:
+                fractured += self.placed_trapezoids(placed)
+                ncollapsed = 0
+                for dose, shape in self.shots(fractured, field, True):
+                    string, poly_type, binary = self.get_str_bin(shape, field, dose)
+                    if poly_type is not None:
+                        ccc.append(poly_type + '(' + string + str(self.pitch) + ',' + str(dose) + ');3\n')
+                        cbc.append(binary)
+                    else:
+                        ncollapsed += 1
+            ccc.append('!END\n')
+            cbc.append(self.end_bytes)
+        amount = sum(len(trs) for _, trs in fractured) if blocks is None else sum(len(n) for _, _, n in blocks)
+        self.telemetry.count('trapezoids', amount, field=name)
+        self.telemetry.count('collapsed', ncollapsed, field=name)
+        return ''.join(ccc), b''.join(cbc), amount
+
+    @staticmethod
+    def ccc_caption(name):
+        return '/*--- ' + name + '.ccc ---*/\n'
+
+    @staticmethod
+    def cbc_caption(name):
+        fcbc_name = name + '.cbc'
+        amount_cc = 24 - len(fcbc_name)  # amount of 0xcc needed after caption
+        return bytes(fcbc_name + ';1.1;', 'utf-8') + bytes([0x00]) + bytes(amount_cc * [0xcc])
+
+    def pat_head(self, dose):
+        # current and pitch of the following shapes in .pat file
+        return 'C ' + str(round(dose * 20) * 50) + '\nI ' + str(self.pitch) + '\n'
+
+    def get_str_pat(self, shape, field, dose, head=True):
         coef = self.field.dots / self.field.size
         points = []
         for p in shape.each_point():
@@ -307,21 +1010,12 @@ class Calculus:
         points.append(points[0])
         area = self.signed_area(points)
         if len(points) < 4:
-            self.outlog.write('Polygon collapsed due to amount of points. Points: [',
-                              ', '.join('(%.3f, %.3f)' % (v.x * self.dbu, v.y * self.dbu) for v in
-                                        shape.each_point()) + ']\n')
+            self.collapsed(self.raw_points(shape), 'amount of points')
             return None
         elif area == 0:
-            self.outlog.write('Polygon collapsed due to zero area. Points: [',
-                              ', '.join('(%.3f, %.3f)' % (v.x * self.dbu, v.y * self.dbu) for v in
-                                        shape.each_point()) + ']\n')
+            self.collapsed(self.raw_points(shape), 'zero area')
             return None
-        min_index, min_value = min(enumerate(points), key=lambda p: (p[1][1], p[1][0]))
-
-        points = points[min_index:] + points[1:min_index + 1]
-
-        if area > 0:
-            points = points[::-1]  # reverse to make counterclockwise
+        points = self.writer_order(points, area, True)  # counterclockwise
 
         if len(points) == 4:
             if points[0][1] == points[1][1]:
@@ -340,20 +1034,15 @@ class Calculus:
                      str(points[0][0]) + ', ' + str(points[0][1]) + ', ' + \
                      str(points[1][0]) + ', ' + str(points[2][0]) + ', ' + \
                      str(points[3][0]) + ', ' + str(points[2][1])
-        outstr = 'C ' + str(round(dose * 20) * 50) + '\nI ' + str(self.pitch) + '\n' + outstr
-        return outstr
+        return self.pat_head(dose) + outstr if head else outstr
 
-    def write_pat_ctl(self, shapes_with_f):
-        for item in listdir(self.dirname):
-            path = join(self.dirname, item)
-            if isfile(path):
-                end = split(item)[-1].lower()
-                if len(end) > 3:
-                    if end[-3:] == 'pat' or end[-3:] == 'ctl':
-                        remove(path)
+    def write_pat_ctl(self, clipped):
         filename = split(self.dirname)[1]
-        fctl = open(join(self.dirname, filename + '.ctl'), 'w')
-        fpat = open(join(self.dirname, filename + '.pat'), 'w')
+        self.load_manifest()
+        if self.incremental:
+            self.old_blocks = read_pat_blocks(join(self.dirname, filename + '.pat'))
+        fctl = open(self.part(filename + '.ctl'), 'w')
+        fpat = open(self.part(filename + '.pat'), 'w')
         head = 'origin = 0, 0\ncurrent = 100\n' \
                'fsize = ' + str(round(self.field.size * self.dbu)) + '\n' \
                                                                      'sfile = ' + filename + '\n\n'
@@ -363,23 +1052,129 @@ class Calculus:
             for mark in self.marks:
                 fctl.write('gmcoord = ' + str(mark[0]*1000) + ', ' + str(mark[1]*1000) + '\n')
             fctl.write('\ngmark (MANUAL)\ngmark (MANUAL)\n\n')
-        fields = sorted(shapes_with_f.keys(), key=lambda f: (f.bottom, f.left))
-        fname = 'field'
-        for i, f in enumerate(fields):
-            if i % 20 == 0:
-                self.timer.update()
-            a = str(round((f.left + f.right) / 2 * self.dbu, 3))
-            b = str(round((f.top + f.bottom) / 2 * self.dbu, 3))
+
+        def write(f, name, result):
             move = 'x = ' + str(round((f.left + f.right) / 2 * self.dbu, 3)) + '\ny = ' + \
                    str(round((f.top + f.bottom) / 2 * self.dbu, 3)) + '\nstage\n'
-            fctl.write(move + 'draw(' + fname + str(i) + ')\n\n')
-            fpat.write('D ' + fname + str(i) + '\n')
-            for dose, shapes in shapes_with_f[f]:
-                for shape in shapes:
-                    string = self.get_str_pat(shape, f, dose)
-                    if string is not None:
-                        fpat.write(string + '\n')
-            fpat.write('END\n\n')
+            fctl.write(move + 'draw(' + name + ')\n\n')
+            fpat.write(result[0])
+
+        try:
+            counts = self.stream(clipped, write)
+        except BaseException:
+            fpat.close()
+            fctl.close()
+            self.discard_parts()
+            raise
         fpat.close()
         fctl.write('end\n')
         fctl.close()
+        self.commit_parts(('pat', 'ctl'), [filename + '.ctl', filename + '.pat'])
+        return counts
+
+    def emit_xenos(self, field, name, shapes, placed=()):
+        # Block of .pat file for one field and amount of trapezoids
+        pat = ['D ' + name + '\n']
+        with self.telemetry.stage('fracture', field=name):
+            fractured, saved, avoided = self.fracture_field(shapes, field)
+        self.fracture_saving(name, saved, avoided)
+        with self.telemetry.stage('emit', field=name):
+            blocks = self.blocks(fractured, placed)
+            encoded = None
+            if blocks is not None:
+                encoded = encoder.encode_xenos(blocks, field, self.field.dots / self.field.size,
+                                               self.hilbert_bits())
+            if encoded is not None:
+                lines, entries, collapsed = encoded
+                for raw, reason, points in collapsed:
+                    self.collapsed(raw, reason, points)
+                heads = [self.pat_head(dose) for dose, _, _ in blocks]
+                last = None
+                for line, e in zip(lines, entries):
+                    pat.append(heads[e] + line + '\n' if heads[e] != last else line + '\n')
+                    last = heads[e] if self.shot_order == 'hilbert' else None
+                ncollapsed = len(collapsed)
+            else:
+                fractured += self.placed_trapezoids(placed)
+                ncollapsed = 0
+                last = None
+                for dose, shape in self.shots(fractured, field, False):
+                    string = self.get_str_pat(shape, field, dose, self.pat_head(dose) != last)
+                    if string is not None:
+                        pat.append(string + '\n')
+                        last = self.pat_head(dose) if self.shot_order == 'hilbert' else None
+                    else:
+                        ncollapsed += 1
+            pat.append('END\n\n')
+        amount = sum(len(trs) for _, trs in fractured) if blocks is None else sum(len(n) for _, _, n in blocks)
+        self.telemetry.count('trapezoids', amount, field=name)
+        self.telemetry.count('collapsed', ncollapsed, field=name)
+        return ''.join(pat), amount
+
+
+def pack_polygons(polys):
+    # Flat array of polygons: amount of contours, then size and coordinates of each contour
+    data = array('i')
+    for poly in polys:
+        data.append(poly.holes() + 1)
+        contours = [poly.each_point_hull()] + [poly.each_point_hole(h) for h in range(poly.holes())]
+        for contour in contours:
+            points = [c for p in contour for c in (p.x, p.y)]
+            data.append(len(points))
+            data.extend(points)
+    return data
+
+
+def unpack_polygons(data):
+    polys, i = [], 0
+    while i < len(data):
+        poly = None
+        for _ in range(data[i]):
+            n = data[i + 1]
+            points = [pya.Point(x, y) for x, y in zip(data[i + 2:i + 2 + n:2], data[i + 3:i + 2 + n:2])]
+            if poly is None:
+                poly = pya.Polygon(points, True)
+            else:
+                poly.insert_hole(points, True)
+            i += n + 1
+        i += 1
+        polys.append(poly)
+    return polys
+
+
+def read_pat_blocks(path):
+    # Blocks of a .pat file by field name, each from 'D name' to 'END'
+    if not isfile(path):
+        return {}
+    with open(path) as f:
+        text = f.read()
+    blocks = {}
+    for block in text.split('END\n\n')[:-1]:
+        blocks[block.split('\n', 1)[0][2:]] = block + 'END\n\n'
+    return blocks
+
+
+def done(result):
+    # Finished future of a field which is not emitted again
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+worker = None
+
+
+def init_worker(state):
+    global worker
+    worker = Calculus.__new__(Calculus)
+    worker.__setstate__(state)
+
+
+def emit_packed(task):
+    box, name, shapes, placed = task
+    worker.outlog.messages = []
+    worker.telemetry = Telemetry()
+    shapes = [(dose, unpack_polygons(data)) for dose, data in shapes]
+    emit = worker.emit_cabl if worker.ebl == 'cabl' else worker.emit_xenos
+    result = emit(pya.Box(*box), name, shapes, placed)
+    return worker.outlog.messages, worker.telemetry.snapshot(), result
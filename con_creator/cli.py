@@ -0,0 +1,206 @@
+"""
+Headless converter working with the standalone klayout module (pip install klayout).
+
+Single design:
+    python -m con_creator.cli chip.gds ~/ebl/chip --ebl cabl --cell TOP --layers 1/0 2/0
+Doses set by rules before the conversion (the file is not changed):
+    python -m con_creator.cli chip.gds ~/ebl/chip --dose-rules con_creator/dose_rules.ini
+Output read back and compared with the layout, fields which differ fail the design:
+    python -m con_creator.cli chip.gds ~/ebl/chip --layers 1/0 2/0 --verify
+Batch of designs, one section of the manifest per design:
+    python -m con_creator.cli --batch manifest.ini
+
+Manifest keys are input, output and the long option names with underscores (field_size, no_marks, ...),
+flags take yes/no values. Keys of the [DEFAULT] section are shared by all designs.
+"""
+import sys
+import argparse
+import configparser
+from pathlib import Path
+try:
+    import pya
+except ImportError:
+    import klayout.db as pya
+
+from con_creator.calculus import Calculus, Field, FIELD_SIZES, FIELD_DOTS, FRACTURE_MODES, SHOT_ORDERS, sort_marks
+from con_creator.fieldorder import FIELD_ORDERS
+from con_creator.doserules import load_rules, apply_rules
+from con_creator import verify
+from con_creator.log import StreamLog
+
+curdir = Path(__file__).resolve().parent
+flags = ('merge', 'no_marks', 'reuse', 'incremental', 'optimize_grid', 'keep_doses', 'verify', 'deep')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='python -m con_creator.cli', description='Convert GDS/OASIS to EBL files.')
+    parser.add_argument('input', nargs='?', help='GDS or OASIS file')
+    parser.add_argument('output', nargs='?', help='output directory, its name is used for .con/.ctl file')
+    parser.add_argument('--batch', help='manifest (ini) with one section per design')
+    parser.add_argument('--ebl', choices=['cabl', 'xenos'], default='cabl')
+    parser.add_argument('--cell', help='top cell name, the top cell of the layout by default')
+    parser.add_argument('--layers', nargs='+', metavar='L/D', help='layers to convert, all layers by default')
+    parser.add_argument('--field-layer', default='', metavar='L/D', help='layer with boxes defining fields')
+    parser.add_argument('--config', help='defaults file, defaults_<ebl>.ini by default')
+    parser.add_argument('--field-size', type=int, help='field size in um')
+    parser.add_argument('--field-dots', type=int, help='field resolution in dots')
+    parser.add_argument('--center', type=float, nargs=2, metavar=('X', 'Y'), help='field center in um')
+    parser.add_argument('--dose', type=float, help='default dose in us')
+    parser.add_argument('--pitch', type=int)
+    parser.add_argument('--marks', type=float, nargs='+', metavar='XY', help='registration marks in um: x1 y1 x2 y2 ...')
+    parser.add_argument('--no-marks', action='store_true', help='no registration marks')
+    parser.add_argument('--merge', action='store_true', help='merge objects of equal dose')
+    parser.add_argument('--reuse', action='store_true',
+                        help='fracture cells once and reuse them for instances lying inside one field')
+    parser.add_argument('--incremental', action='store_true',
+                        help='write only fields which changed since the previous conversion into the output')
+    parser.add_argument('--optimize-grid', action='store_true',
+                        help='move the field center to cut fewer shapes, without a field layer')
+    parser.add_argument('--fracture', choices=FRACTURE_MODES, default=FRACTURE_MODES[0],
+                        help='best: decomposition with fewest shots and collapsed pieces for every polygon')
+    parser.add_argument('--field-order', choices=FIELD_ORDERS, default=FIELD_ORDERS[0],
+                        help='order of exposure: raster rows, serpentine rows or nearest neighbour with 2-opt')
+    parser.add_argument('--shot-order', choices=SHOT_ORDERS, default=SHOT_ORDERS[0],
+                        help='hilbert: shots of a field grouped by dose along a Hilbert curve, '
+                             'current of .pat written only when it changes')
+    parser.add_argument('--pec', type=float, nargs=3, metavar=('ALPHA', 'BETA', 'ETA'),
+                        help='proximity effect correction: forward and backward scattering ranges in um and '
+                             'ratio of backscattered energy')
+    parser.add_argument('--dose-rules', metavar='FILE', help='ini or JSON file with rules setting doses of shapes')
+    parser.add_argument('--keep-doses', action='store_true', help='dose rules do not change shapes having a dose')
+    parser.add_argument('--processes', type=int, default=1, help='fracture and format fields in a process pool')
+    parser.add_argument('--deep', action='store_true',
+                        help='keep shapes in a hierarchical copy of the layout, flattened field by field')
+    parser.add_argument('--verify', action='store_true',
+                        help='read the output back and compare it with the layout, a mismatch fails the design')
+    return parser
+
+
+def load_defaults(ebl, config_path=None):
+    # reading parameters from defaults_*.ini in the same way ConverterDialog does
+    config = configparser.ConfigParser()
+    config.read(config_path or curdir / ('defaults_' + ebl + '.ini'))
+    nmarks = 2 if ebl == 'cabl' else 4
+    defaults = {
+        'dose': float(config['General']['dose']),
+        'pitch': int(config['General']['pitch']),
+        'field_size': FIELD_SIZES[ebl][int(config['Field']['field_size index'])],
+        'field_dots': FIELD_DOTS[ebl][int(config['Field']['field_dots index'])],
+        'center': [float(config['Field']['field_center_x']), float(config['Field']['field_center_y'])],
+        'marks': None,
+    }
+    if config.getboolean('Reg_marks', 'reg_marks'):
+        defaults['marks'] = [(float(config['Reg_marks']['reg_mark' + str(i + 1) + '_x']),
+                              float(config['Reg_marks']['reg_mark' + str(i + 1) + '_y'])) for i in range(nmarks)]
+    return defaults
+
+
+def get_layers(ly, names, field_layer):
+    if names is None:
+        return list(ly.layer_indexes())
+    names = set(names) | ({field_layer} if field_layer else set())
+    layers = []
+    for layer_index in ly.layer_indexes():
+        info = ly.get_info(layer_index)
+        if str(info.layer) + '/' + str(info.datatype) in names:
+            layers.append(layer_index)
+    return layers
+
+
+def convert(args, outlog, layouts=None):
+    # layouts caches the last loaded layout between designs of a batch
+    layouts = {} if layouts is None else layouts
+    defaults = load_defaults(args.ebl, args.config)
+    for key in ('dose', 'pitch', 'field_size', 'field_dots', 'center'):
+        if getattr(args, key) is not None:
+            defaults[key] = getattr(args, key)
+    if args.marks is not None:
+        defaults['marks'] = list(zip(args.marks[::2], args.marks[1::2]))
+    marks = None
+    if defaults['marks'] is not None and not args.no_marks:
+        marks = sort_marks(args.ebl, [(x / 1000, y / 1000) for x, y in defaults['marks']])
+
+    if args.input not in layouts:
+        layouts.clear()
+        ly = pya.Layout()
+        ly.read(args.input)
+        layouts[args.input] = ly
+    ly = layouts[args.input]
+    cell = ly.cell(args.cell) if args.cell else ly.top_cell()
+    if cell is None:
+        raise ValueError('There is no cell ' + args.cell + ' in ' + args.input)
+    if args.dose_rules:
+        # doses are set in the loaded layout only, it is read again by the next design
+        layouts.pop(args.input)
+        counts = apply_rules(ly, cell, load_rules(args.dose_rules), defaults['dose'], args.keep_doses)
+        outlog.write('Dose rules: ', ', '.join(name + ' ' + str(n) for name, n in counts.items()), ' shapes.\n')
+    dirname = Path(args.output).expanduser().resolve()
+    dirname.mkdir(parents=True, exist_ok=True)
+
+    field = Field(defaults['field_size'], defaults['field_dots'], list(defaults['center']))
+    outlog.write('Converting ', args.input, ' (', cell.name, ') to ', dirname, '\n')
+    outlog.write('Starting with following parameters:\nField: size = ', field.size, ' um, dots = ', field.dots,
+                 ' and center = ', field.center, ' um.\n')
+    if marks is not None:
+        outlog.write('Registration marks: ', marks, ' mm.\n')
+    else:
+        outlog.write('No registration marks.\n')
+    worker = Calculus(args.ebl, str(dirname), field, marks, False, 'x', defaults['pitch'], defaults['dose'], outlog,
+                      args.field_layer, args.merge, processes=args.processes, reuse=args.reuse,
+                      incremental=args.incremental, fracture_mode=args.fracture,
+                      optimize_grid=args.optimize_grid, field_order=args.field_order,
+                      shot_order=args.shot_order, proximity=args.pec, deep=args.deep)
+    result = worker.convert(ly, cell, get_layers(ly, args.layers, args.field_layer))
+    if args.verify:
+        check = argparse.Namespace(output=str(dirname), ebl=args.ebl, input=args.input, cell=cell.name,
+                                   layers=args.layers, field_layer=args.field_layer, dose=defaults['dose'],
+                                   field_dots=field.dots, tolerance=2.0, quiet=True)
+        if not verify.run(check, outlog, ly):
+            raise ValueError('Output in ' + str(dirname) + ' differs from the layout')
+    return result
+
+
+def read_manifest(parser, path):
+    # every section of the manifest becomes command line arguments of one design
+    manifest = configparser.ConfigParser()
+    manifest.read(path)
+    jobs = []
+    for section in manifest.sections():
+        argv = [manifest[section]['input'], manifest[section]['output']]
+        for key, value in manifest[section].items():
+            if key in ('input', 'output'):
+                continue
+            if key in flags:
+                if manifest[section].getboolean(key):
+                    argv.append('--' + key.replace('_', '-'))
+            else:
+                argv.extend(['--' + key.replace('_', '-')] + value.split())
+        jobs.append((section, parser.parse_args(argv)))
+    return jobs
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    outlog = StreamLog()
+    if args.batch:
+        jobs = read_manifest(parser, args.batch)
+    elif args.input and args.output:
+        jobs = [(args.input, args)]
+    else:
+        parser.error('input and output or --batch are required')
+
+    layouts, failed = {}, []
+    for name, job in jobs:
+        try:
+            convert(job, outlog, layouts)
+        except Exception as e:
+            outlog.write('Conversion of ', name, ' failed: ', repr(e), '\n')
+            failed.append(name)
+    if len(jobs) > 1:
+        outlog.write(len(jobs) - len(failed), ' of ', len(jobs), ' designs converted.\n')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
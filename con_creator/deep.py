@@ -0,0 +1,142 @@
+"""
+Hierarchical collection of shapes. Converted layers are copied into a scratch layout keeping the cell
+hierarchy: every cell is copied once for every dose its instances pass down, shapes without own doses are
+copied natively in one go and instance arrays stay arrays. Every (layer, dose) gets its own layer of the
+scratch layout, so doses need no per-shape bookkeeping. Polygons are materialized one field at a time by
+region queries of the scratch layout and clipped by KLayout, nothing is flattened before clipping.
+"""
+from collections import defaultdict
+from con_creator.doses import DoseResolver
+try:
+    import pya
+except ImportError:
+    import klayout.db as pya
+
+
+class DeepShapes:
+    """
+    Snapshot of layers of a cell, split by dose. Behaves like the list of (dose, polygon) of the flat
+    collection for len(), fields are taken by field()
+    """
+
+    def __init__(self, ly, cell, layers, resolver=None):
+        self.layout = pya.Layout()
+        self.layout.dbu = ly.dbu
+        self.layers = layers
+        self.resolver = resolver or DoseResolver()
+        self.targets = {}  # (source layer, dose) -> layer of the scratch layout, in order of appearance
+        self.variants = {}  # (cell index, dose) -> (scratch cell index, flat amount of shapes per source layer)
+        self.filled = {}  # cell index -> cell has shapes on some of the layers
+        index, self.counts = self.variant(cell, None)
+        self.top = self.layout.cell(index)
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def regions(self, dose):
+        # flat region of every dose for proximity correction, which needs all shapes at once. Regions are
+        # filled by KLayout from the hierarchy, shapes without dose get the given one
+        groups = {}
+        for (_, d), index in self.targets.items():
+            groups.setdefault(d if d is not None else dose, pya.Region()).insert(self.top.begin_shapes_rec(index))
+        return groups
+
+    def target(self, layer, dose):
+        key = (layer, dose)
+        if key not in self.targets:
+            self.targets[key] = self.layout.layer()
+        return self.targets[key]
+
+    def has_shapes(self, cell):
+        index = cell.cell_index()
+        if index not in self.filled:
+            self.filled[index] = any(not cell.bbox_per_layer(layer).empty() for layer in self.layers)
+        return self.filled[index]
+
+    def variant(self, cell, dose):
+        # copy of the cell for shapes inheriting the dose, its children are copied first
+        key = (cell.cell_index(), dose)
+        if key in self.variants:
+            return self.variants[key]
+        target = self.layout.create_cell(cell.name if dose is None else '%s$%g' % (cell.name, dose))
+        counts = defaultdict(int)
+        for layer in self.layers:
+            shapes = cell.shapes(layer)
+            if shapes.is_empty():
+                continue
+            counts[layer] += shapes.size()
+            if not any(self.resolver.dose(s) is not None for s in shapes.each(pya.Shapes.SAllWithProperties)):
+                target.shapes(self.target(layer, dose)).insert(shapes)
+                continue
+            for s in shapes.each():
+                d = self.resolver.dose(s)
+                target.shapes(self.target(layer, d if d is not None else dose)).insert(s.polygon)
+        for inst in cell.each_inst():
+            if not self.has_shapes(inst.cell):
+                continue
+            d = self.resolver.dose(inst)
+            index, child = self.variant(inst.cell, d if d is not None else dose)
+            array = inst.cell_inst
+            array.cell_index = index
+            target.insert(array)
+            for layer, n in child.items():
+                counts[layer] += n * array.size()
+        self.variants[key] = target.cell_index(), counts
+        return self.variants[key]
+
+    def occupied(self, box):
+        # some shape has its bounding box overlapping the box
+        return any(not self.top.begin_shapes_rec_overlapping(index, box).at_end() for index in self.targets.values())
+
+    def fields(self, field_index):
+        """
+        Fields with shapes overlapping them. Fields of a field layer are queried one by one, the grid is
+        divided recursively from the bounding box, so empty parts are skipped as a whole
+        """
+        bbox = self.top.bbox()
+        if bbox.empty():
+            return []
+        if field_index.ownfields:
+            return [f for f in field_index.get_fields(bbox) if self.occupied(f)]
+        (kx0, ky0), (kx1, ky1) = field_index.key(bbox.left, bbox.bottom), field_index.key(bbox.right, bbox.top)
+        fields = []
+        ranges = [(kx0, ky0, kx1, ky1)]
+        while ranges:
+            x0, y0, x1, y1 = ranges.pop()
+            box = field_index.box((x0, y0)) + field_index.box((x1, y1))
+            if not self.occupied(box):
+                continue
+            if x0 == x1 and y0 == y1:
+                fields.append(box)
+            elif x1 - x0 >= y1 - y0:
+                xm = (x0 + x1) // 2
+                ranges += [(x0, y0, xm, y1), (xm + 1, y0, x1, y1)]
+            else:
+                ym = (y0 + y1) // 2
+                ranges += [(x0, y0, x1, ym), (x0, ym + 1, x1, y1)]
+        return fields
+
+    def field(self, box, dose, merge):
+        """
+        [dose, polygons clipped to the box] of shapes overlapping the box, shapes without dose get the given one.
+        merge: shapes of equal dose are merged, otherwise every (layer, dose) is one entry of unmerged shapes
+        """
+        clip = pya.Region(box)
+        entries = []
+        groups = {}
+        for (_, d), index in self.targets.items():
+            it = self.top.begin_shapes_rec_overlapping(index, box)
+            if it.at_end():
+                continue
+            d = d if d is not None else dose
+            if merge:
+                groups.setdefault(d, pya.Region()).insert(it)
+                continue
+            region = pya.Region(it)
+            region.merged_semantics = False
+            entries.append([d, list((region & clip).each())])
+        for d, region in groups.items():
+            # a single box clips polygon by polygon without merging them
+            region.min_coherence = True
+            entries.append([d, list((region.merged() & clip).each())])
+        return [entry for entry in entries if entry[1]]
@@ -0,0 +1,177 @@
+"""
+Rule based assignment of doses. Rules are read from an ini file (one section per rule) or a JSON file
+({"rules": [{...}, ...]}) and are tried in their order, the first matching rule sets the 'dose' property
+of a shape. Every cell is processed once, so doses stay in the hierarchy like doses set by DoseAssigner.
+Shapes of a cell and layer are matched in bulk by region filters of KLayout, polygon by polygon,
+and the properties are written afterwards in one pass.
+
+Keys of a rule:
+    layer      L/D of shapes, all layers if missing
+    cell       fnmatch pattern of cell names, * by default
+    width      min, max in um: smallest width of the shape found by a width check, the short side of rectangles
+    area       min, max in um^2
+    perimeter  min, max in um
+    dose       dose in us
+    factor     dose as a multiple of the base dose (the default dose of the converter)
+A bin includes its minimum and excludes its maximum, an empty bound is open: "width = , 0.1".
+Bounds are rounded up to database units.
+"""
+import json
+import configparser
+from fnmatch import fnmatchcase
+from math import ceil
+from con_creator.doses import DoseResolver
+try:
+    import pya
+except ImportError:
+    import klayout.db as pya
+
+BINS = ('width', 'area', 'perimeter')
+
+
+class Rule:
+    def __init__(self, name, layer=None, cell='*', width=None, area=None, perimeter=None, dose=None, factor=None):
+        if (dose is None) == (factor is None):
+            raise ValueError('Rule ' + name + ' needs either dose or factor')
+        self.name = name
+        self.layer = layer
+        self.cell = cell
+        self.bins = {key: value for key, value in zip(BINS, (width, area, perimeter)) if value is not None}
+        self.dose = dose
+        self.factor = factor
+
+    def value(self, base):
+        # dose set by the rule
+        return self.dose if self.dose is not None else self.factor * base
+
+    def select(self, region, dbu):
+        # polygons of the region (raw, without merging) inside all bins
+        for key, (lo, hi) in self.bins.items():
+            if key == 'area':
+                region = raw(region.with_area(to_dbu(lo, dbu ** 2), to_dbu(hi, dbu ** 2), False))
+            elif key == 'perimeter':
+                region = raw(region.with_perimeter(to_dbu(lo, dbu), to_dbu(hi, dbu), False))
+            else:
+                # the width of rectangles is their shorter side, other polygons narrower than d
+                # have results of their own width check
+                others = raw(region.non_rectangles())
+                for bound, narrower in ((hi, True), (lo, False)):
+                    if bound is not None:
+                        check = pya.CompoundRegionOperationNode.new_width_check(to_dbu(bound, dbu))
+                        others = raw(others.complex_op(pya.CompoundRegionOperationNode.new_logical_boolean(
+                            pya.CompoundRegionOperationNode.LogicalOp.LogAnd, not narrower, [check])))
+                rectangles = raw(region.rectangles()).with_bbox_min(to_dbu(lo, dbu), to_dbu(hi, dbu), False)
+                region = raw(rectangles + others)
+        return region
+
+
+def raw(region):
+    # shapes are filtered one by one as they are, not merged with their neighbours
+    region.merged_semantics = False
+    return region
+
+
+def to_dbu(value, unit):
+    # bound in um or um^2 as database units rounded up, None stays open
+    return None if value is None else int(ceil(round(value / unit, 6)))
+
+
+def parse_bin(value):
+    # "min, max" or [min, max] with empty or null bounds -> (min, max)
+    if isinstance(value, str):
+        value = value.split(',')
+    if len(value) != 2:
+        raise ValueError('A bin needs two bounds: ' + repr(value))
+    return tuple(None if v is None or str(v).strip() == '' else float(v) for v in value)
+
+
+def make_rule(name, items):
+    kwargs = {}
+    for key, value in items.items():
+        if key in BINS:
+            kwargs[key] = parse_bin(value)
+        elif key in ('dose', 'factor'):
+            kwargs[key] = float(value)
+        elif key in ('layer', 'cell'):
+            kwargs[key] = str(value).strip()
+        elif key != 'name':
+            raise ValueError('Unknown key ' + key + ' in rule ' + name)
+    return Rule(name, **kwargs)
+
+
+def load_rules(path):
+    # list of rules from an ini or JSON file
+    path = str(path)
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            data = json.load(f)
+        return [make_rule(str(item.get('name', i + 1)), item) for i, item in enumerate(data['rules'])]
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise OSError('Cannot read dose rules from ' + path)
+    return [make_rule(section, dict(config.items(section, raw=True))) for section in config.sections()]
+
+
+def inherited_cells(cell, resolver):
+    # indices of cells below the cell reached by an instance path passing a dose down
+    dosed, seen, stack = set(), set(), [(cell, False)]
+    while stack:
+        c, inherits = stack.pop()
+        if (c.cell_index(), inherits) in seen:
+            continue
+        seen.add((c.cell_index(), inherits))
+        if inherits:
+            dosed.add(c.cell_index())
+        for inst in c.each_inst():
+            stack.append((inst.cell, inherits or resolver.dose(inst) is not None))
+    return dosed
+
+
+def apply_rules(ly, cell, rules, base, keep=False):
+    """
+    Sets doses of shapes in the cell and all cells below it. base: dose multiplied by factors.
+    keep: shapes already having a dose are not changed, neither their own nor one inherited from an instance.
+    A cell reached with a dose on some instance path is skipped as a whole, a dose of its shapes would
+    replace the inherited one there.
+    Returns amount of shapes set by every rule (rule name -> amount)
+    """
+    counts = dict.fromkeys((rule.name for rule in rules), 0)
+    names = {li: str(ly.get_info(li).layer) + '/' + str(ly.get_info(li).datatype) for li in ly.layer_indexes()}
+    resolver = DoseResolver()
+    skipped = inherited_cells(cell, resolver) if keep else set()
+    prop_ids = {}  # (properties id, dose) -> properties id with the dose
+    cells = [cell] + [ly.cell(ci) for ci in cell.called_cells()]
+    for c in cells:
+        if c.cell_index() in skipped:
+            continue
+        for layer_index, layer_name in names.items():
+            candidates = [r for r in rules if fnmatchcase(c.name, r.cell) and r.layer in (None, layer_name)]
+            shapes = c.shapes(layer_index)
+            if not candidates or shapes.is_empty():
+                continue
+            rest = raw(pya.Region(shapes))
+            chosen = []
+            for rule in candidates:
+                matched = rule.select(rest, ly.dbu)
+                if matched.is_empty():
+                    continue
+                rest = raw(rest.not_in(matched))
+                value = f'{rule.value(base):.2f}'
+                # every shape equal to a matched polygon is found, identical shapes by the first of them
+                for poly in set(matched.each()):
+                    box = poly.bbox()
+                    for shape in shapes.each_overlapping(box):
+                        if shape.bbox() == box and shape.polygon == poly and \
+                                not (keep and resolver.dose(shape) is not None):
+                            chosen.append((shape, value, rule.name))
+                if rest.is_empty():
+                    break
+            # properties are written after matching, setting them changes the shape containers
+            for shape, value, name in chosen:
+                key = (shape.prop_id, value)
+                if key not in prop_ids:
+                    properties = [p for p in ly.properties(shape.prop_id) if p[0] != 'dose']
+                    prop_ids[key] = ly.properties_id(properties + [['dose', value]])
+                shape.prop_id = prop_ids[key]
+                counts[name] += 1
+    return counts
@@ -0,0 +1,73 @@
+try:
+    import pya
+except ImportError:
+    import klayout.db as pya
+
+# Callbacks without arguments called after doses were assigned in the layout view, the dose visualizer
+# draws doses again by them. The list survives importlib.reload of this module by the macros
+try:
+    listeners
+except NameError:
+    listeners = []
+
+
+def doses_changed():
+    for callback in list(listeners):
+        callback()
+
+
+class DoseResolver:
+    """
+    Dose of a shape is its own 'dose' property or the dose of the deepest instance in its
+    instance path having one. Properties are looked up once per properties id and instance
+    doses are passed down the hierarchy, so every instance path prefix is resolved only once.
+    """
+
+    def __init__(self):
+        self.cache = {}
+
+    def dose(self, obj):
+        # dose of a shape or an instance, None if not assigned
+        prop_id = obj.prop_id
+        if prop_id == 0:
+            return None
+        if prop_id not in self.cache:
+            d = obj.property('dose')
+            self.cache[prop_id] = float(d) if d is not None else None
+        return self.cache[prop_id]
+
+    def each_polygon(self, cell, layer, trans=None, dose=None, place=None, region=None):
+        """
+        (dose, polygon in coordinates of the initial cell) for all shapes of the layer in the cell hierarchy.
+        place(cell, trans, dose) is asked for every instance, if it returns True the instance is not flattened.
+        region: box in coordinates of the initial cell, only shapes and instances touching it are visited
+        """
+        if trans is None:
+            # bounding boxes of a layout built in memory are only valid after an update, which must not
+            # happen while shapes or instances are iterated
+            cell.layout().update()
+            trans = pya.ICplxTrans()
+        bboxes = {}
+        for index in cell.each_child_cell():
+            bboxes[index] = cell.layout().cell(index).bbox_per_layer(layer)
+        if region is None:
+            shapes, insts = cell.each_shape(layer), cell.each_inst()
+        else:
+            local = region.transformed(trans.inverted())
+            shapes, insts = cell.shapes(layer).each_touching(local), cell.each_touching_inst(local)
+        for shape in shapes:
+            d = self.dose(shape)
+            yield d if d is not None else dose, shape.polygon.transformed(trans)
+        for inst in insts:
+            bbox = bboxes[inst.cell_index]
+            if bbox.empty():
+                continue
+            child = inst.cell
+            d = self.dose(inst)
+            d = d if d is not None else dose
+            for t in inst.cell_inst.each_cplx_trans():
+                if region is not None and not bbox.transformed(trans * t).touches(region):
+                    continue
+                if place is not None and place(child, trans * t, d):
+                    continue
+                yield from self.each_polygon(child, layer, trans * t, d, place, region)
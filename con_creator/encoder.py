@@ -0,0 +1,213 @@
+"""
+Vectorized formatting of all trapezoids of a field at once. The output is byte-identical
+to Calculus.get_str_bin and Calculus.get_str_pat, which remain in use when NumPy is not available.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DWSL, DWTL, DWTZL = 0, 1, 2
+poly_types = ('DWSL', 'DWTL', 'DWTZL')
+
+
+def record_dtype(direction):
+    # layout of a .cbc record: header, Struct('< 3i 3f 2i')
+    return np.dtype([('head', 'u1', (len(bytes(direction, 'utf-8')) + 5,)),
+                     ('x0', '<i4'), ('y0', '<i4'), ('w', '<i4'),
+                     ('slope1', '<f4'), ('pitch', '<f4'), ('slope2', '<f4'),
+                     ('h', '<i4'), ('dose', '<i4')])
+
+
+def trapezoid_points(trs):
+    """
+    Points of trapezoids in database units as (N, 4, 2) array and amounts of points (3 or 4),
+    the last point of triangles is repeated. None if some polygon has another amount of points,
+    such fields are left to the scalar functions.
+    """
+    n = np.fromiter((tr.num_points() for tr in trs), dtype=np.int64, count=len(trs))
+    if n.size and (n.min() < 3 or n.max() > 4):
+        return None
+    flat = np.fromiter((c for tr in trs for p in tr.each_point() for c in (p.x, p.y)),
+                       dtype=np.int64, count=2 * int(n.sum())).reshape(-1, 2)
+    starts = np.cumsum(n) - n
+    return flat[starts[:, None] + np.minimum(np.arange(4), n[:, None] - 1)].reshape(-1, 4, 2), n
+
+
+def placed_blocks(placed):
+    # blocks of trapezoids of reused cells: (cell blocks, offsets) -> (dose, points, n) moved by every offset
+    blocks = []
+    for cell_blocks, offsets in placed:
+        for dose, points, n in cell_blocks:
+            moved = points[None, :, :, :] + offsets[:, None, None, :]
+            blocks.append((dose, moved.reshape(-1, 4, 2), np.tile(n, len(offsets))))
+    return blocks
+
+
+def hilbert_bits(dots):
+    # order of the Hilbert curve covering every dot of a field, coordinates are 0 .. dots - 1
+    return max(1, (dots - 1).bit_length())
+
+
+def hilbert_index(x, y, bits):
+    # distance of point (x, y) along the Hilbert curve through a 2^bits square
+    side = 1 << bits
+    x, y = min(max(x, 0), side - 1), min(max(y, 0), side - 1)
+    d = 0
+    s = side >> 1
+    while s:
+        rx, ry = int(x & s > 0), int(y & s > 0)
+        d += s * s * ((3 * rx) ^ ry)
+        if not ry:
+            if rx:
+                x, y = side - 1 - x, side - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def hilbert_keys(x, y, bits):
+    # hilbert_index of arrays of points
+    side = 1 << bits
+    x, y = np.clip(x, 0, side - 1), np.clip(y, 0, side - 1)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = side >> 1
+    while s:
+        rx, ry = (x & s) > 0, (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        flip = ~ry & rx
+        x, y = np.where(flip, side - 1 - x, x), np.where(flip, side - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+def shot_order(points, n, doses, bits):
+    # shots grouped by dose and ordered along the Hilbert curve through centers of their bounding boxes
+    valid = np.arange(4)[None, :] < n[:, None]
+    big = np.iinfo(np.int64).max
+    lo = np.where(valid[..., None], points, big).min(axis=1)
+    hi = np.where(valid[..., None], points, -big).max(axis=1)
+    center = (lo + hi) // 2
+    return np.lexsort((hilbert_keys(center[:, 0], center[:, 1], bits), doses))
+
+
+def field_points(blocks, field, coef, flip, hilbert=0):
+    """
+    blocks: list of (dose, points, n) in database units
+    Points of all trapezoids in field coordinates, amounts of points, index of the block
+    of every trapezoid and raw points. None if there are no trapezoids.
+    flip: y axis is directed downwards from the top of the field (CABL)
+    hilbert: bits of the Hilbert curve (hilbert_bits) to sort trapezoids by shot_order, 0 keeps the order of blocks
+    """
+    if not blocks or sum(len(n) for _, _, n in blocks) == 0:
+        return None
+    raw = np.concatenate([points for _, points, _ in blocks])
+    n = np.concatenate([n for _, _, n in blocks])
+    entry = np.repeat(np.arange(len(blocks)), [len(n) for _, _, n in blocks])
+    dx = raw[..., 0] - field.left
+    dy = field.top - raw[..., 1] if flip else raw[..., 1] - field.bottom
+    points = np.stack([np.trunc(dx * coef), np.trunc(dy * coef)], axis=-1).astype(np.int64)
+    if hilbert:
+        order = shot_order(points, n, np.array([dose for dose, _, _ in blocks], dtype=float)[entry], hilbert)
+        points, n, entry, raw = points[order], n[order], entry[order], raw[order]
+    return points, n, entry, raw
+
+
+def canonical(points, n, reverse_positive):
+    """
+    Signed area and vertex order used by the scalar writers: starting from the lowest point
+    (smallest y, then x) and reversed depending on the sign of the area
+    """
+    rows = np.arange(len(points))[:, None]
+    k = np.arange(4)[None, :]
+    valid = k < n[:, None]
+    prev = points[rows, (k - 1) % n[:, None]]
+    area = np.where(valid, (points[..., 0] - prev[..., 0]) * (points[..., 1] + prev[..., 1]), 0).sum(axis=1)
+    key = np.where(valid, points[..., 1] * (1 << 32) + points[..., 0], np.iinfo(np.int64).max)
+    start = key.argmin(axis=1)
+    step = np.where(area > 0 if reverse_positive else area < 0, -1, 1)
+    return area, points[rows, (start[:, None] + step[:, None] * k) % n[:, None]]
+
+
+def encode_cabl(blocks, field, coef, pitch, direction, hilbert=0):
+    """
+    blocks: list of (dose, points, n) in database units
+    Returns lines of .ccc file, .cbc records and collapsed trapezoids
+    as (points in database units, reason, points in field coordinates)
+    """
+    prepared = field_points(blocks, field, coef, True, hilbert)
+    if prepared is None:
+        return None
+    points, n, entry, raw = prepared
+    area, r = canonical(points, n, False)
+    rows = np.arange(len(r))
+    x0, y0, x1, y1, x2, y2 = r[:, 0, 0], r[:, 0, 1], r[:, 1, 0], r[:, 1, 1], r[:, 2, 0], r[:, 2, 1]
+    xl, yl = r[rows, n - 1, 0], r[rows, n - 1, 1]
+    h = y1 - y0
+    hs = np.where(h == 0, 1, h)
+    slope1 = (x1 - x0) / hs
+    width = np.where(yl != y0, 1, xl - x0)
+    slope2 = np.where(y2 != y1, (1 - width) / hs, (x2 - x1 - width) / hs)
+    kind = np.where(n == 3, DWTL, np.where((slope1 != 0) | (slope2 != 0), DWTZL, DWSL))
+
+    collapsed = []
+    for i in np.flatnonzero((area == 0) | (h == 0)).tolist():
+        if area[i] == 0:
+            collapsed.append((raw[i, :n[i]].tolist(), 'zero area', None))
+        else:
+            ring = [tuple(p) for p in r[i, :n[i]].tolist()]
+            collapsed.append((raw[i, :n[i]].tolist(), 'ZeroDivisionError', ring + ring[:1]))
+    keep = (area != 0) & (h != 0)
+
+    records = np.zeros(int(keep.sum()), dtype=record_dtype(direction))
+    records['head'] = np.frombuffer(bytes([0x01, 0x08, 0x13, 0x00]) + bytes(direction, 'utf-8') + bytes([0x00]),
+                                    dtype=np.uint8)
+    records['x0'], records['y0'], records['w'] = x0[keep], y0[keep], width[keep]
+    records['slope1'], records['pitch'], records['slope2'] = slope1[keep], pitch, slope2[keep]
+    records['h'] = h[keep] + 1
+    records['dose'] = np.array([round(dose * 100) for dose, _, _ in blocks], dtype=np.int64)[entry[keep]]
+
+    tails = [str(pitch) + ',' + str(dose) + ');3\n' for dose, _, _ in blocks]
+    formats = {3: '%d,%d,%d,%d,%d,%d,', 4: '%d,%d,%d,%d,%d,%d,%d,%d,'}
+    lines = []
+    for t, c, e, m in zip(kind[keep].tolist(), r[keep].reshape(-1, 8).tolist(), entry[keep].tolist(),
+                          n[keep].tolist()):
+        if t == DWSL:
+            coords = '%d,%d,%d,%d,' % (c[0], c[1], c[4], c[5])
+        else:
+            coords = formats[m] % tuple(c[:2 * m])
+        lines.append(poly_types[t] + '(' + coords + tails[e])
+    return lines, records.tobytes(), collapsed
+
+
+def encode_xenos(blocks, field, coef, hilbert=0):
+    """
+    blocks: list of (dose, points, n) in database units
+    Returns shape lines of .pat file (without current and pitch) with block index of each
+    and collapsed trapezoids as (points in database units, reason, None)
+    """
+    prepared = field_points(blocks, field, coef, False, hilbert)
+    if prepared is None:
+        return None
+    points, n, entry, raw = prepared
+    area, r = canonical(points, n, True)
+    q = r.copy()
+    # triangles are written as trapezoids with a degenerate edge
+    tri = n == 3
+    flat = tri & (r[:, 0, 1] == r[:, 1, 1])
+    q[flat, 3] = r[flat, 2]
+    apex = tri & ~flat
+    q[apex, 1], q[apex, 2], q[apex, 3] = r[apex, 0], r[apex, 1], r[apex, 2]
+    rect = (q[:, 0, 0] == q[:, 3, 0]) & (q[:, 0, 1] == q[:, 1, 1]) & \
+           (q[:, 1, 0] == q[:, 2, 0]) & (q[:, 2, 1] == q[:, 3, 1])
+
+    collapsed = [(raw[i, :n[i]].tolist(), 'zero area', None) for i in np.flatnonzero(area == 0).tolist()]
+    keep = area != 0
+    lines = []
+    for is_rect, c in zip(rect[keep].tolist(), q[keep].reshape(-1, 8).tolist()):
+        if is_rect:
+            lines.append('RECT %d, %d, %d, %d' % (c[0], c[1], c[4], c[5]))
+        else:
+            lines.append('XPOLY %d, %d, %d, %d, %d, %d' % (c[0], c[1], c[2], c[4], c[6], c[5]))
+    return lines, entry[keep].tolist(), collapsed
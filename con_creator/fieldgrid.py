@@ -0,0 +1,74 @@
+"""
+Placement of the field grid without a field layer. Bounding box edges are histogrammed modulo
+the field size for each axis, which gives the amount of boxes cut by a grid line at every offset.
+The best offsets of both axes are then checked exactly in pairs for cut boxes and occupied fields.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def axis_candidates(lo, hi, size, k):
+    # offsets of grid lines (0 <= offset < size) in the k segments crossing fewest boxes along one axis
+    width = hi - lo
+    short = width < size  # longer boxes are cut anyway
+    a = np.mod(lo[short], size)
+    b = a + width[short]
+    wrap = b > size
+    nwrap = int(wrap.sum())
+    pos = np.concatenate([a, np.minimum(b, size), np.zeros(nwrap, dtype=a.dtype), b[wrap] - size])
+    delta = np.concatenate([np.ones(len(a)), -np.ones(len(a)), np.ones(nwrap), -np.ones(nwrap)])
+    order = np.argsort(pos, kind='stable')
+    # amount of crossed boxes is constant on every segment between two edges
+    starts = np.concatenate([[0], pos[order]])
+    ends = np.concatenate([pos[order], [size]])
+    counts = np.concatenate([[0], np.cumsum(delta[order])])
+    length = ends - starts
+    valid = length > 0
+    best = np.lexsort((-length[valid], counts[valid]))[:k]
+    return [int(x) for x in ((starts[valid] + ends[valid]) // 2)[best]]
+
+
+def field_range(lo, hi, size, offset):
+    # first and last grid index of fields sharing area with [lo, hi]
+    first = np.floor((lo - offset) / size).astype(np.int64)
+    last = np.ceil((hi - offset) / size).astype(np.int64) - 1
+    return first, np.maximum(first, last)
+
+
+def evaluate(boxes, size, gx, gy):
+    # amount of cut boxes and of occupied fields for grid lines at gx, gy (modulo size)
+    left, bottom, right, top = boxes
+    kx0, kx1 = field_range(left, right, size, gx)
+    ky0, ky1 = field_range(bottom, top, size, gy)
+    cut = (kx1 > kx0) | (ky1 > ky0)
+    single = np.unique(np.stack([kx0[~cut], ky0[~cut]], axis=1), axis=0)
+    fields = set(map(tuple, single.tolist()))
+    for i in np.flatnonzero(cut).tolist():
+        for kx in range(kx0[i], kx1[i] + 1):
+            for ky in range(ky0[i], ky1[i] + 1):
+                fields.add((kx, ky))
+    return int(cut.sum()), len(fields)
+
+
+def optimize(boxes, size, center, k=5):
+    """
+    boxes: arrays of left, bottom, right and top of shapes, size and center of fields in database units.
+    Returns center with fewest cut boxes (then fewest fields) near the given one,
+    (cuts, fields) of the given center and of the returned one
+    """
+    grid = (center[0] + 0.5 * size, center[1] + 0.5 * size)  # grid lines of FieldIndex
+    base = evaluate(boxes, size, *grid)
+    if len(boxes[0]) == 0:
+        return center, base, base
+    left, bottom, right, top = boxes
+    trials = [(evaluate(boxes, size, gx, gy), gx, gy) for gx in axis_candidates(left, right, size, k)
+              for gy in axis_candidates(bottom, top, size, k)]
+    best, gx, gy = min(trials, key=lambda t: t[0])
+    if best >= base:
+        return center, base, base
+    # the same grid with the center closest to the given one
+    shift = [(g - c) % size for g, c in zip((gx, gy), grid)]
+    shift = [s - size if s > size / 2 else s for s in shift]
+    return [int(center[0] + shift[0]), int(center[1] + shift[1])], base, best
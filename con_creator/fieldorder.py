@@ -0,0 +1,91 @@
+"""
+Order in which fields are exposed. The stage moves between field centers, so the order decides
+the total travel of the stage. raster is the historical order (rows from the bottom, left to right),
+serpentine reverses every second row and nearest builds a nearest neighbour path improved by 2-opt,
+which helps most on sparse layouts with scattered fields.
+"""
+from math import hypot
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FIELD_ORDERS = ('raster', 'serpentine', 'nearest')
+
+
+def center(f):
+    return (f.left + f.right) / 2, (f.bottom + f.top) / 2
+
+
+def travel(fields):
+    # length of the path through centers of fields in the given order, in database units
+    centers = [center(f) for f in fields]
+    return sum(hypot(x1 - x0, y1 - y0) for (x0, y0), (x1, y1) in zip(centers, centers[1:]))
+
+
+def raster(fields):
+    return sorted(fields, key=lambda f: (f.bottom, f.left))
+
+
+def serpentine(fields):
+    # rows of fields with equal bottom, every second row from right to left
+    rows = {}
+    for f in raster(fields):
+        rows.setdefault(f.bottom, []).append(f)
+    ordered = []
+    for i, row in enumerate(rows.values()):
+        ordered.extend(reversed(row) if i % 2 else row)
+    return ordered
+
+
+def nearest_path(xy):
+    # indices of a nearest neighbour path starting at the first point
+    left = np.ones(len(xy), dtype=bool)
+    path = [0]
+    left[0] = False
+    for _ in range(len(xy) - 1):
+        d = np.hypot(xy[:, 0] - xy[path[-1], 0], xy[:, 1] - xy[path[-1], 1])
+        d[~left] = np.inf
+        path.append(int(d.argmin()))
+        left[path[-1]] = False
+    return np.array(path)
+
+
+def two_opt(xy, path, passes=20):
+    # reverses segments of the open path while that makes it shorter, best move for every start.
+    # A pass takes quadratic time, large layouts get fewer passes
+    n = len(path)
+    for _ in range(max(1, min(passes, int(4e7 / n ** 2)))):
+        improved = False
+        for i in range(n - 1):
+            p = xy[path]
+            j = np.arange(i + 1, n)
+            delta = np.zeros(len(j))
+            if i > 0:
+                delta += np.hypot(*(p[i - 1] - p[j]).T) - np.hypot(*(p[i - 1] - p[i]))
+            inner = j < n - 1
+            nxt = p[np.minimum(j + 1, n - 1)]
+            delta += np.where(inner, np.hypot(*(p[i] - nxt).T) - np.hypot(*(p[j] - nxt).T), 0)
+            k = int(delta.argmin())
+            if delta[k] < -1e-9 * (1 + abs(delta[k])):
+                path[i:j[k] + 1] = path[i:j[k] + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return path
+
+
+def nearest(fields):
+    # nearest neighbour path from the first raster field, shortened by 2-opt
+    fields = raster(fields)
+    if len(fields) < 3:
+        return fields
+    xy = np.array([center(f) for f in fields], dtype=float)
+    return [fields[i] for i in two_opt(xy, nearest_path(xy)).tolist()]
+
+
+ORDERS = {'raster': raster, 'serpentine': serpentine, 'nearest': nearest}
+
+
+def order(fields, strategy='raster'):
+    return ORDERS[strategy](fields)
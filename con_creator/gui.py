@@ -1,11 +1,17 @@
 import importlib
 import configparser
+from time import time
+from threading import Thread
 from pathlib import Path
 import pya
 
+from con_creator import log
+importlib.reload(log)
 from con_creator import calculus
 importlib.reload(calculus)
-from con_creator.calculus import Calculus
+from con_creator.calculus import Calculus, Cancelled, Field, FIELD_SIZES, FIELD_DOTS, sort_marks
+from con_creator.log import QueueLog
+from con_creator.fieldorder import FIELD_ORDERS
 
 curdir = Path(__file__).resolve().parent
 lastdir = curdir / '.lastdir'
@@ -27,12 +33,6 @@ class OutLog:
             self.edit.setTextColor(tc)
 
 
-class Field:
-    def __init__(self, size, dots, center):
-        self.size = size
-        self.dots = dots
-        self.center = center
-
 class ConverterDialog(pya.QDialog):
     """
     This class implements a dialog for design convert
@@ -73,18 +73,12 @@ class ConverterDialog(pya.QDialog):
         self.field_groupbox = pya.QGroupBox('Field', self)
         grid = pya.QGridLayout()
         self.field_size = pya.QComboBox(self)
-        if self.ebl == 'cabl':
-            self.field_size.addItems(['60', '120', '300', '600', '1200'])
-        elif self.ebl == 'xenos':
-            self.field_size.addItems(['50', '100', '250', '500', '1000'])
+        self.field_size.addItems([str(s) for s in FIELD_SIZES[self.ebl]])
         grid.addWidget(self.field_size, 0, 0)
         self.label_um = pya.QLabel('um', self)
         grid.addWidget(self.label_um, 0, 1)
         self.field_dots = pya.QComboBox(self)
-        if self.ebl == 'cabl':
-            self.field_dots.addItems(['10000', '20000', '60000', '240000'])
-        elif self.ebl == 'xenos':
-            self.field_dots.addItems(['50000'])
+        self.field_dots.addItems([str(d) for d in FIELD_DOTS[self.ebl]])
         grid.addWidget(self.field_dots, 1, 0)
         self.label_dots = pya.QLabel('dots', self)
         grid.addWidget(self.label_dots, 1, 1)
@@ -158,6 +152,11 @@ class ConverterDialog(pya.QDialog):
 
         self.visible_flag = pya.QCheckBox('Only visible layers', self)
         self.merge_flag = pya.QCheckBox('Merge objects', self)
+        self.incremental_flag = pya.QCheckBox('Only changed fields', self)
+        self.best_fracture_flag = pya.QCheckBox('Fewest shots', self)
+        self.optimize_grid_flag = pya.QCheckBox('Optimize field center', self)
+        self.sort_shots_flag = pya.QCheckBox('Sort shots by dose and position', self)
+        self.deep_flag = pya.QCheckBox('Keep hierarchy until clipping', self)
         self.along_x_button = pya.QRadioButton('Along X axis', self)
         self.along_x_button.setChecked(True)
         self.along_x_button.setEnabled(False)
@@ -177,10 +176,19 @@ class ConverterDialog(pya.QDialog):
         self.pitch.setRange(1, 99)
         grid.addWidget(self.pitch, 1, 1)
         grid.addWidget(pya.QLabel('', self), 1, 2)
+        grid.addWidget(pya.QLabel('Order', self), 2, 0)
+        self.field_order = pya.QComboBox(self)
+        self.field_order.addItems(list(FIELD_ORDERS))
+        grid.addWidget(self.field_order, 2, 1)
 
         vbox3 = pya.QVBoxLayout()
         vbox3.addWidget(self.visible_flag)
         vbox3.addWidget(self.merge_flag)
+        vbox3.addWidget(self.incremental_flag)
+        vbox3.addWidget(self.best_fracture_flag)
+        vbox3.addWidget(self.optimize_grid_flag)
+        vbox3.addWidget(self.sort_shots_flag)
+        vbox3.addWidget(self.deep_flag)
         vbox3.addWidget(self.along_x_button)
         vbox3.addLayout(grid)
         vbox3.addStretch()
@@ -209,11 +217,22 @@ class ConverterDialog(pya.QDialog):
         self.textEdit.setReadOnly(True)
         vbox.addWidget(self.textEdit)
 
+        self.progress_bar = pya.QProgressBar(self)
+        self.progress_bar.setValue(0)
+        self.eta_label = pya.QLabel('', self)
+        hbox = pya.QHBoxLayout()
+        hbox.addWidget(self.progress_bar)
+        hbox.addWidget(self.eta_label)
+        vbox.addLayout(hbox)
+
         self.clear_button = pya.QPushButton('Clear', self)
+        self.cancel_button = pya.QPushButton('Cancel', self)
+        self.cancel_button.setEnabled(False)
         self.convert_button = pya.QPushButton('Convert', self)
         hbox = pya.QHBoxLayout()
         hbox.addWidget(self.clear_button)
         hbox.addStretch()
+        hbox.addWidget(self.cancel_button)
         hbox.addWidget(self.convert_button)
         vbox.addLayout(hbox)
 
@@ -245,8 +264,16 @@ class ConverterDialog(pya.QDialog):
         self.browse_button.clicked(self._browse_button_clicked)
         self.clear_button.clicked(self._clear_button_clicked)
         self.convert_button.clicked(self._convert_button_clicked)
+        self.cancel_button.clicked(self._cancel_button_clicked)
 
         self.outlog = OutLog(self.textEdit)
+        # conversion runs in a thread, the timer shows its log and progress
+        self.worker = None
+        self.thread = None
+        self.queuelog = QueueLog()
+        self.poll_timer = pya.QTimer(self)
+        self.poll_timer.setInterval(100)
+        self.poll_timer.timeout(self._poll)
         self.convert_button.setEnabled(False)
         if self.ebl == 'xenos':
             self.field_dots.currentIndex = 0
@@ -274,11 +301,18 @@ class ConverterDialog(pya.QDialog):
         # self.along_x_button.setEnabled(flag)
         self.dose.setEnabled(enable)
         self.pitch.setEnabled(enable)
+        self.field_order.setEnabled(enable)
         self.convert_button.setEnabled(enable)
         self.field_layer_box.setEnabled(enable)
         self.merge_flag.setEnabled(enable)
+        self.incremental_flag.setEnabled(enable)
+        self.best_fracture_flag.setEnabled(enable)
+        self.sort_shots_flag.setEnabled(enable)
+        self.deep_flag.setEnabled(enable)
+        self.optimize_grid_flag.setEnabled(enable and not self.field_layer_box.checked)
 
     def _toggle_center(self, clicked):
+        self.optimize_grid_flag.setEnabled(not clicked)
         self.center_groupbox.setEnabled(not clicked)  # self.center_groupbox.checked)
 
     def _clear_button_clicked(self, clicked):
@@ -307,12 +341,7 @@ class ConverterDialog(pya.QDialog):
         dirname = self.filename_str.displayText
 
         if self.reg_flag.checked:
-            marks = [(m[0].value / 1000, m[1].value / 1000) for m in self.marks]
-            if self.ebl == 'cabl':
-                if marks[0][1] > marks[1][1] or (marks[0][0] > marks[1][0] and marks[0][1] == marks[1][1]):
-                    marks[0], marks[1] = marks[1], marks[0]
-            elif self.ebl == 'xenos':
-                pass
+            marks = sort_marks(self.ebl, [(m[0].value / 1000, m[1].value / 1000) for m in self.marks])
         else:
             marks = None
 
@@ -329,11 +358,68 @@ class ConverterDialog(pya.QDialog):
         else:
             field_layer = ''
 
-        self.worker = Calculus(self.ebl, dirname, field, marks, self.visible_flag.checked, direction, pitch, dose, self.outlog,
-                               field_layer, self.merge_flag.checked)
-        self.worker.start()
+        self.worker = Calculus(self.ebl, dirname, field, marks, self.visible_flag.checked, direction, pitch, dose,
+                               self.queuelog, field_layer, self.merge_flag.checked,
+                               incremental=self.incremental_flag.checked,
+                               fracture_mode='best' if self.best_fracture_flag.checked else 'htrapezoids',
+                               optimize_grid=self.optimize_grid_flag.checked,
+                               field_order=self.field_order.currentText,
+                               shot_order='hilbert' if self.sort_shots_flag.checked else 'collected',
+                               deep=self.deep_flag.checked)
+        # geometry is copied in the GUI thread, the layout may be edited while the thread converts the copy
+        try:
+            self.worker.start()
+        except Exception as e:
+            self.queuelog.drain(self.outlog)
+            self.outlog.write('Conversion failed: ', repr(e), '\n')
+            self.set_elements(True)
+            return
+        self.queuelog.drain(self.outlog)
+        self.outdir = dirname
+        self.succeeded = False
+        # (time, fields done) when fields were first reported, collection and division do not count for the rate
+        self.first_field = None
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.cancel_button.setEnabled(True)
+        self.poll_timer.start()
+
+    def _run(self):
+        try:
+            self.worker.run()
+            self.succeeded = True
+        except Cancelled:
+            self.queuelog.write('Conversion cancelled, output directory is unchanged.\n')
+        except Exception as e:
+            self.queuelog.write('Conversion failed: ', repr(e), '\n')
+
+    def _poll(self):
+        self.queuelog.drain(self.outlog)
+        done, total = self.worker.progress
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(done)
+        if not total:
+            self.eta_label.setText('%d shapes collected' % self.worker.collected)
+        elif done:
+            if self.first_field is None:
+                self.first_field = time(), done
+            start, first = self.first_field
+            if done > first:
+                eta = (time() - start) * (total - done) / (done - first)
+                self.eta_label.setText('%d / %d fields, %d s left' % (done, total, eta))
+            else:
+                self.eta_label.setText('%d / %d fields' % (done, total))
+        if self.thread.is_alive():
+            return
+        self.poll_timer.stop()
+        self.queuelog.drain(self.outlog)
+        self.cancel_button.setEnabled(False)
+        self.eta_label.setText('')
         self.set_elements(True)
-
-        if self.uselastdir:
+        if self.succeeded and self.uselastdir:
             with open(lastdir, 'w') as f:
-                f.write(str(Path(dirname).resolve().parent))
\ No newline at end of file
+                f.write(str(Path(self.outdir).resolve().parent))
+
+    def _cancel_button_clicked(self, clicked):
+        if self.worker is not None:
+            self.worker.cancel()
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Log sinks of the converter. Calculus wraps the given sink into WarningLog, which shows only
+the first examples of every kind of warning and writes everything into a log file.
+"""
+import sys
+from os import remove, replace
+from queue import Queue, Empty
+
+
+class StreamLog:
+    # console output of the command line
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+
+    def write(self, *args):
+        for argv in args:
+            self.stream.write(str(argv))
+        self.stream.flush()
+
+
+class ListLog:
+    # Collects messages of a worker process, they are replayed into the real log by the main process
+    def __init__(self):
+        self.messages = []
+
+    def write(self, *args):
+        self.messages.append(('write', args))
+
+    def warn(self, kind, *args):
+        self.messages.append(('warn', (kind,) + args))
+
+
+class QueueLog:
+    # Log of the conversion thread, the dialog moves the messages into its text box by a timer
+    def __init__(self):
+        self.queue = Queue()
+
+    def write(self, *args):
+        self.queue.put(''.join(str(argv) for argv in args))
+
+    def drain(self, log):
+        # all waiting messages are written at once
+        messages = []
+        while True:
+            try:
+                messages.append(self.queue.get_nowait())
+            except Empty:
+                break
+        if messages:
+            log.write(''.join(messages))
+
+
+class WarningLog:
+    """
+    Messages are passed to the sink. Warnings are counted by kind and only the first examples
+    of each kind reach the sink, the log file gets all messages and warnings. The file is written
+    as <path>.part and replaces <path> when it is closed with keep=True
+    """
+
+    def __init__(self, sink, examples=5):
+        self.sink = sink
+        self.examples = examples
+        self.counts = {}
+        self.path = None
+        self.file = None
+
+    def open(self, path):
+        self.close()
+        self.path = path
+        self.file = open(path + '.part', 'w')
+        self.counts = {}
+
+    def close(self, keep=True):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            if keep:
+                replace(self.path + '.part', self.path)
+            else:
+                remove(self.path + '.part')
+
+    def write(self, *args):
+        self.sink.write(*args)
+        if self.file is not None:
+            self.file.write(''.join(str(argv) for argv in args))
+
+    def warn(self, kind, *args):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if self.counts[kind] <= self.examples:
+            self.sink.write(*args)
+        if self.file is not None:
+            self.file.write(''.join(str(argv) for argv in args))
+
+    def summary(self):
+        # amounts of warnings which were not shown completely
+        for kind, n in self.counts.items():
+            if n > self.examples:
+                where = ', all of them are in ' + self.path if self.path else ''
+                self.write(kind, ': ', n, ' warnings, first ', self.examples, ' shown', where, '\n')
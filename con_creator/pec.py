@@ -0,0 +1,161 @@
+"""
+Proximity effect correction on a density grid. Shapes of all fields are rasterized once into coverage
+and dose maps covering every field and its neighbourhood. The exposure of the double-Gaussian point
+spread function
+    psf(r) = (exp(-r^2 / alpha^2) / (pi alpha^2) + eta exp(-r^2 / beta^2) / (pi beta^2)) / (1 + eta)
+is computed by FFT and the dose map is scaled iteratively, until shapes receive the exposure of a large
+uniformly exposed area of their original dose. Trapezoids of a field get the correction of their
+position, trapezoids on which the correction varies are cut along the pixel grid into pieces with own doses.
+"""
+from collections import defaultdict
+from math import ceil, sqrt
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pya
+except ImportError:
+    import klayout.db as pya
+
+
+class Corrector:
+    def __init__(self, alpha, beta, eta, dbu, pixel=None, iterations=10, tolerance=0.02, max_pixels=1 << 22,
+                 max_pieces=256):
+        """
+        alpha, beta: forward and backward scattering ranges in um, eta: ratio of backscattered energy,
+        pixel: grid step in um (beta / 4 by default, larger if the grid would exceed max_pixels),
+        tolerance: relative variation of the correction over a trapezoid which causes its splitting
+        """
+        self.dbu = dbu
+        self.alpha = alpha / dbu
+        self.beta = beta / dbu
+        self.eta = eta
+        self.pixel = pixel / dbu if pixel else self.beta / 4
+        self.iterations = iterations
+        self.tolerance = tolerance
+        self.max_pixels = max_pixels
+        self.max_pieces = max_pieces
+        self.factor = None
+        self.split = 0  # amount of split trapezoids
+
+    @staticmethod
+    def group(shapes, default, check=None):
+        # regions of (dose or None, polygon) in database units by dose, default: dose of shapes without one,
+        # check: called now and then, raises to stop
+        groups = defaultdict(pya.Region)
+        for i, (dose, shape) in enumerate(shapes):
+            if not i & 0xffff and check is not None:
+                check()
+            groups[dose if dose is not None else default].insert(shape)
+        return groups
+
+    def build(self, groups, check=None):
+        # groups: dose -> region of all shapes with the dose in database units,
+        # check: called now and then, raises to stop the build
+        bbox = pya.Box()
+        for region in groups.values():
+            bbox += region.bbox()
+        margin = 3 * self.beta  # backscattering of shapes outside does not wrap around in the FFT
+        width, height = bbox.width() + 2 * margin, bbox.height() + 2 * margin
+        self.pixel = max(self.pixel, sqrt(width * height / self.max_pixels), 1)
+        step = int(ceil(self.pixel))
+        self.pixel = step
+        self.nx, self.ny = int(ceil(width / step)) + 1, int(ceil(height / step)) + 1
+        self.origin = (int(bbox.left - margin), int(bbox.bottom - margin))
+        cover = np.zeros((self.ny, self.nx))
+        density = np.zeros((self.ny, self.nx))
+        for dose, region in groups.items():
+            area = np.array(region.rasterize(pya.Point(*self.origin), pya.Vector(step, step), self.nx, self.ny))
+            area /= step * step
+            cover += area
+            density += dose * area
+        self.factor = self.correct(cover, density, check)
+        covered = self.factor[density > 0]
+        self.lo, self.hi = (covered.min(), covered.max()) if covered.size else (1.0, 1.0)
+
+    def convolve(self, grid, sigma):
+        # grid convolved with the normalized Gaussian exp(-r^2 / sigma^2) / (pi sigma^2)
+        fy = np.fft.fftfreq(grid.shape[0], self.pixel)[:, None]
+        fx = np.fft.rfftfreq(grid.shape[1], self.pixel)[None, :]
+        kernel = np.exp(-np.pi ** 2 * sigma ** 2 * (fx ** 2 + fy ** 2))
+        return np.fft.irfft2(np.fft.rfft2(grid) * kernel, grid.shape)
+
+    def correct(self, cover, density, check=None):
+        """
+        Factors of doses on the grid. Exposure of a shape in a pixel is the forward part of its own dose,
+        reduced where the shape is narrower than alpha, and the backscattering of all doses around it
+        """
+        p = np.where(cover > 1e-6, cover, 1)
+        target = np.where(cover > 1e-6, density / p, 0)
+        inside = target > 0  # shapes of zero dose are not corrected
+        forward = np.clip(self.convolve(cover, self.alpha) / p, 1e-3, 1)
+        dose = target.copy()
+        for _ in range(self.iterations):
+            if check is not None:
+                check()
+            exposure = (dose * forward + self.eta * self.convolve(cover * dose, self.beta)) / (1 + self.eta)
+            dose = np.where(inside, dose * target / np.where(inside, np.maximum(exposure, 1e-12 * target), 1), 0)
+        factor = np.where(inside, dose / np.where(inside, target, 1), 0)
+        # empty pixels take factors of covered pixels around them, so interpolation near edges is not diluted
+        weight = self.convolve(inside.astype(float), self.pixel)
+        near = np.where(weight > 1e-6, self.convolve(factor, self.pixel) / np.where(weight > 1e-6, weight, 1), 1)
+        return np.where(inside, factor, near)
+
+    def sample(self, x, y):
+        # bilinear interpolation of factors at points in database units
+        fx = np.clip((np.asarray(x, dtype=float) - self.origin[0]) / self.pixel - 0.5, 0, self.nx - 1)
+        fy = np.clip((np.asarray(y, dtype=float) - self.origin[1]) / self.pixel - 0.5, 0, self.ny - 1)
+        x0, y0 = np.minimum(fx.astype(int), self.nx - 2), np.minimum(fy.astype(int), self.ny - 2)
+        wx, wy = fx - x0, fy - y0
+        f = self.factor
+        return (f[y0, x0] * (1 - wx) * (1 - wy) + f[y0, x0 + 1] * wx * (1 - wy) +
+                f[y0 + 1, x0] * (1 - wx) * wy + f[y0 + 1, x0 + 1] * wx * wy)
+
+    def pieces(self, poly, box):
+        # polygon cut by tiles of whole pixels into at most about max_pieces pieces, every tile is clipped
+        # on its own, so pieces of neighbouring tiles stay apart
+        cell = self.pixel * max(1, int(ceil(sqrt(box.width() * box.height() / self.max_pieces) / self.pixel)))
+        x0 = self.origin[0] + (box.left - self.origin[0]) // cell * cell
+        y0 = self.origin[1] + (box.bottom - self.origin[1]) // cell * cell
+        pieces = []
+        for x in range(x0, box.right, cell):
+            for y in range(y0, box.top, cell):
+                tile = pya.Polygon(pya.Box(x, y, x + cell, y + cell))
+                pieces.extend(pya.EdgeProcessor().boolean_p2p([poly], [tile], pya.EdgeProcessor.ModeAnd, True, True))
+        return pieces
+
+    def apply(self, entries):
+        """
+        entries: (dose, trapezoids) of one fractured field. Returns [dose, polygons] with corrected doses,
+        rounded to 0.01 us, trapezoids and pieces of equal corrected dose are grouped
+        """
+        # trapezoids come as simple polygons, the writers fracture polygons
+        trs = [(dose, pya.Polygon(tr)) for dose, group in entries for tr in group]
+        boxes = np.array([(b.left, b.bottom, b.right, b.top) for b in (tr.bbox() for _, tr in trs)],
+                         dtype=float).reshape(-1, 4)
+        # factors on a 3x3 grid over every bounding box, the center one is used for unsplit trapezoids
+        t = np.array([0.0, 0.5, 1.0])
+        xs = boxes[:, 0, None, None] + (boxes[:, 2] - boxes[:, 0])[:, None, None] * t[None, None, :]
+        ys = boxes[:, 1, None, None] + (boxes[:, 3] - boxes[:, 1])[:, None, None] * t[None, :, None]
+        samples = self.sample(*np.broadcast_arrays(xs, ys)).reshape(len(trs), 9)
+        center = samples[:, 4]
+        vary = (samples.max(axis=1) - samples.min(axis=1) > self.tolerance * center) & \
+               (np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]) > self.pixel)
+        corrected = defaultdict(list)
+        for (dose, tr), factor, split in zip(trs, center.tolist(), vary.tolist()):
+            if not split:
+                corrected[round(dose * factor, 2)].append(tr)
+                continue
+            self.split += 1
+            pieces = self.pieces(tr, tr.bbox())
+            centers = np.array([(b.center().x, b.center().y) for b in (piece.bbox() for piece in pieces)],
+                               dtype=float).reshape(-1, 2)
+            for piece, f in zip(pieces, self.sample(centers[:, 0], centers[:, 1]).tolist()):
+                corrected[round(dose * f, 2)].append(piece)
+        return [[dose, group] for dose, group in corrected.items()]
+
+    def summary(self):
+        # line for the log
+        return ('Proximity correction: grid %d x %d with %.3g um pixels, dose factors %.3f - %.3f, '
+                '%d split trapezoids' % (self.nx, self.ny, self.pixel * self.dbu, self.lo, self.hi, self.split))
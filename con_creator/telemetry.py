@@ -0,0 +1,105 @@
+"""
+Telemetry of a conversion: wall and CPU time of stages, counts and peak memory.
+Stages and counts may be attributed to a layer or a field, so slow layers and fields are visible
+in the report. Calculus writes the report as JSON next to the output files and passes it
+to every function registered with add_hook.
+"""
+import sys
+from time import perf_counter, thread_time
+from threading import Lock
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+hooks = []
+
+
+def add_hook(hook):
+    # hook(report) is called with the report of every conversion
+    hooks.append(hook)
+
+
+def peak_memory(children=False):
+    # maximum resident set size in MB, ru_maxrss is in bytes on macOS and in kB elsewhere, None if unknown
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+class Telemetry:
+    def __init__(self):
+        self.lock = Lock()  # the writer thread records its stage concurrently
+        self.stages = {}  # stage -> {'wall': s, 'cpu': s, 'calls': n}
+        self.counts = {}
+        self.layers = {}  # layer name -> {'<stage>_wall': s, '<stage>_cpu': s, '<count>': n}
+        self.fields = {}  # field name -> the same
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """
+        Measures the block as stage name. labels (layer, field) may also be set inside the block:
+            with telemetry.stage('clip') as labels:
+                labels['field'] = ...
+        """
+        wall, cpu = perf_counter(), thread_time()
+        try:
+            yield labels
+        finally:
+            self.add(name, perf_counter() - wall, thread_time() - cpu, **labels)
+
+    def records(self, layer=None, field=None):
+        # records of the layer and the field the measurement belongs to
+        if layer is not None:
+            yield self.layers.setdefault(layer, {})
+        if field is not None:
+            yield self.fields.setdefault(field, {})
+
+    def add(self, name, wall, cpu, layer=None, field=None):
+        with self.lock:
+            total = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            total['wall'] += wall
+            total['cpu'] += cpu
+            total['calls'] += 1
+            for record in self.records(layer, field):
+                record[name + '_wall'] = record.get(name + '_wall', 0.0) + wall
+                record[name + '_cpu'] = record.get(name + '_cpu', 0.0) + cpu
+
+    def count(self, name, n=1, layer=None, field=None):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+            for record in self.records(layer, field):
+                record[name] = record.get(name, 0) + n
+
+    def snapshot(self):
+        # plain data of the measurements, sent from worker processes to the main one
+        with self.lock:
+            return {'stages': self.stages, 'counts': self.counts, 'layers': self.layers, 'fields': self.fields}
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, total in snapshot['stages'].items():
+                mine = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+                for key in mine:
+                    mine[key] += total[key]
+            for name, n in snapshot['counts'].items():
+                self.counts[name] = self.counts.get(name, 0) + n
+            for kind in ('layers', 'fields'):
+                records = getattr(self, kind)
+                for key, record in snapshot[kind].items():
+                    mine = records.setdefault(key, {})
+                    for name, value in record.items():
+                        mine[name] = mine.get(name, 0) + value
+
+    def report(self, **info):
+        # everything measured with info about the run (parameters, total time)
+        report = dict(info)
+        report.update(self.snapshot())
+        report['peak_memory_mb'] = {'main': peak_memory(), 'workers': peak_memory(True)}
+        return report
+
+    def summary(self):
+        # one line with wall times of stages for the log
+        return 'Stages: ' + ', '.join('%s %.2f s' % (name, total['wall']) for name, total in self.stages.items())
@@ -0,0 +1,411 @@
+"""
+Reader and verifier of converted output. Fields are read from .con/.cbc/.ccc (CABL) or .ctl/.pat (Xenos)
+through memory maps: .cbc records are a NumPy view of the file, numbers of .ccc and .pat lines are parsed
+from the map in chunks, so only one field is held in memory at a time. Trapezoids of a field are rebuilt in layout
+coordinates (from the .cbc records for CABL, the same data the tool reads) and compared with the shapes
+of the source layout inside the field:
+
+    python -m con_creator.verify ~/ebl/chip --input chip.gds --cell TOP --layers 1/0 2/0
+    python -m con_creator.verify ~/ebl/chip --ebl xenos --field-dots 50000
+
+Coordinates in dots are truncated by the converter, x and y separately, so slanted edges may move by up
+to two dots. The XOR of output and source is therefore opened by half of the tolerance (two dots by
+default) and only the rest counts as mismatch. Shapes of the source without any overlap with the output are reported as dropped,
+they are usually collapsed shapes listed in the log of the conversion. Every field gets the amount and
+area of shots per dose, the source gets its area per dose (doses differ after proximity correction).
+Without the source layout only the output is read and summarized.
+"""
+import re
+import sys
+import mmap
+import argparse
+from math import ceil
+from os.path import isfile, join, split, expanduser, abspath
+from collections import defaultdict
+from con_creator import encoder
+from con_creator.calculus import FIELD_DOTS
+from con_creator.doses import DoseResolver
+from con_creator.log import StreamLog
+try:
+    import pya
+except ImportError:
+    import klayout.db as pya
+
+np = encoder.np
+CAPTION = 30  # bytes of 'name.cbc;1.1;' padded with 0xcc
+END = bytes([0xff, 0xff, 0x13, 0x00] + 34 * [0xcc])
+pat_block = re.compile(rb'^D (\S+)\n', re.M)
+# letters and punctuation of .ccc and .pat lines, numbers are parsed after replacing them by spaces
+SEPARATORS = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ(),;', b' ' * 30)
+CHUNK = 1 << 22  # bytes of lines parsed at once
+
+
+def mapped(path):
+    # read-only memory map of a file, empty bytes for empty files
+    with open(path, 'rb') as f:
+        if not f.seek(0, 2):
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def numbers(data, start, end):
+    """
+    Numbers of the lines of a mapped .ccc or .pat file between start and end as float array. Separators are
+    replaced in chunks of whole lines, so only one chunk is copied out of the map at a time
+    """
+    parts = []
+    while start < end:
+        stop = data.find(b'\n', min(start + CHUNK, end) - 1, end) + 1 or end
+        parts.append(np.array(data[start:stop].translate(SEPARATORS).split(), dtype=float))
+        start = stop
+    return np.concatenate(parts) if parts else np.zeros(0)
+
+
+def line_starts(data, start, end):
+    # first bytes of the lines between start and end of a mapped file (a view of the map) and their offsets
+    text = np.frombuffer(data, dtype=np.uint8, count=end - start, offset=start)
+    starts = np.r_[0, np.flatnonzero(text == ord('\n'))[:-1] + 1]
+    return text, starts
+
+
+def read_con(path):
+    # field size in um, dots and centers of fields (name -> (x, y) in um) of a .con file
+    with open(path) as f:
+        text = f.read()
+    size, dots = re.search(r'^CZ([\d.]+),(\d+);', text, re.M).groups()
+    centers = {name: (float(x) * 1000, float(y) * 1000)
+               for name, x, y in re.findall(r'^PC(\S+);\n([-\d.e]+),([-\d.e]+);', text, re.M)}
+    return float(size) * 1000, int(dots), centers
+
+
+def read_ctl(path):
+    # field size in um and centers of fields (name -> (x, y) in um) of a .ctl file
+    with open(path) as f:
+        text = f.read()
+    size = float(re.search(r'^fsize = ([\d.]+)', text, re.M).group(1))
+    centers = {name: (float(x), float(y))
+               for x, y, name in re.findall(r'^x = ([-\d.e]+)\ny = ([-\d.e]+)\nstage\ndraw\((\S+)\)', text, re.M)}
+    return size, centers
+
+
+def read_cbc(path):
+    """
+    Records of a .cbc file as structured array (see encoder.record_dtype) mapped from the file.
+    Raises ValueError if the caption or the end record is missing or the size does not fit the records
+    """
+    data = mapped(path)
+    if len(data) < CAPTION + len(END) or data[-len(END):] != END:
+        raise ValueError(path + ' has no end record')
+    body = memoryview(data)[CAPTION:len(data) - len(END)]
+    if not len(body):
+        return np.zeros(0, dtype=encoder.record_dtype('x'))
+    head = bytes(body[:64])
+    direction = head[4:head.index(b'\x00', 4)].decode()
+    dtype = encoder.record_dtype(direction)
+    if len(body) % dtype.itemsize:
+        raise ValueError(path + ' is not a sequence of records of ' + str(dtype.itemsize) + ' bytes')
+    return np.frombuffer(body, dtype=dtype)
+
+
+def cbc_points(records):
+    """
+    Trapezoids of .cbc records as (N, 4, 2) points in dots (y downwards from the top of the field) and doses.
+    The writer stores a width of one dot for pointed ends, they are rebuilt as such
+    """
+    x0, y0, w = records['x0'].astype(np.float64), records['y0'].astype(np.float64), records['w'].astype(np.float64)
+    h = records['h'] - 1.0
+    x1 = x0 + records['slope1'] * h
+    x2 = x1 + w + records['slope2'] * h
+    points = np.stack([np.stack([x0, y0], -1), np.stack([x1, y0 + h], -1), np.stack([x2, y0 + h], -1),
+                       np.stack([x0 + w, y0], -1)], axis=1)
+    return np.rint(points).astype(np.int64), records['dose'] / 100
+
+
+def read_ccc(path):
+    # trapezoids of a .ccc file as (N, 4, 2) points in dots (the last point of triangles repeated) and doses
+    data = mapped(path)
+    start, end = data.find(b'PATTERN\n') + 8, data.rfind(b'!END')
+    if start == 7 or end < start:
+        raise ValueError(path + ' has no PATTERN section')
+    if end == start:
+        return np.zeros((0, 4, 2), dtype=np.int64), np.zeros(0)
+    # DWSL, DWTL and DWTZL lines have 4, 6 and 8 coordinates followed by pitch, dose and 3,
+    # they differ in the third and the fourth letter
+    text, starts = line_starts(data, start, end)
+    kind = np.where(text[starts + 2] == ord('S'), 0, np.where(text[starts + 3] == ord('L'), 1, 2))
+    n = np.array([7, 9, 11])[kind]
+    values = numbers(data, start, end)
+    if len(values) != n.sum():
+        raise ValueError(path + ' has unexpected lines')
+    offsets = np.cumsum(n) - n
+    c = np.rint(values[offsets[:, None] + np.minimum(np.arange(8), n[:, None] - 4)]).astype(np.int64)
+    rect, triangle = kind == 0, kind == 1
+    c[rect] = c[rect][:, [0, 1, 0, 3, 2, 3, 2, 1]]
+    c[triangle, 6:] = c[triangle, 4:6]
+    return c.reshape(-1, 4, 2), values[offsets + n - 2]
+
+
+def read_pat(path):
+    """
+    Generator of the fields of a .pat file as (name, (N, 4, 2) points in dots, doses), y upwards
+    from the bottom of the field. Doses are currents of the shapes divided by 1000
+    """
+    data = mapped(path)
+    pos = 0
+    while True:
+        head = pat_block.search(data, pos)
+        if head is None:
+            return
+        end = data.find(b'\nEND\n', head.end() - 1)
+        if end < 0:
+            raise ValueError(path + ' has no END of ' + head.group(1).decode())
+        pos = end + 5
+        if head.end() == end + 1:
+            yield head.group(1).decode(), np.zeros((0, 4, 2), dtype=np.int64), np.zeros(0)
+            continue
+        # C current, I pitch, RECT x0, y0, x2, y2 and XPOLY x0, y0, x1, x2, x3, y2
+        text, starts = line_starts(data, head.end(), end + 1)
+        first = text[starts]
+        n = np.select([first == ord('R'), first == ord('X')], [4, 6], 1)
+        values = numbers(data, head.end(), end + 1)
+        if len(values) != n.sum():
+            raise ValueError(path + ' has unexpected lines in ' + head.group(1).decode())
+        v = np.rint(values[(np.cumsum(n) - n)[:, None] + np.minimum(np.arange(6), n[:, None] - 1)]).astype(np.int64)
+        current = first == ord('C')
+        # every shape gets the last current before it
+        last = np.maximum.accumulate(np.where(current, np.arange(len(first)), 0))
+        rect, shape = first == ord('R'), (first == ord('R')) | (first == ord('X'))
+        x0, y0 = v[:, 0], v[:, 1]
+        x1, x2 = v[:, 2], np.where(rect, v[:, 2], v[:, 3])
+        x3, y2 = np.where(rect, v[:, 0], v[:, 4]), np.where(rect, v[:, 3], v[:, 5])
+        points = np.stack([x0, y0, x1, y0, x2, y2, x3, y2], -1)[shape]
+        yield head.group(1).decode(), points.reshape(-1, 4, 2), v[last, 0][shape] / 1000
+
+
+def read_output(dirname, ebl, dots=None):
+    """
+    Generator of the fields of an output directory as (name, center in um, size in um, dots,
+    points in dots, doses, flip, consistency problems)
+    """
+    base = split(dirname)[1]
+    if ebl == 'cabl':
+        size, dots, centers = read_con(join(dirname, base + '.con'))
+        for name, center in centers.items():
+            problems = []
+            if not isfile(join(dirname, name + '.cbc')):
+                yield name, center, size, dots, np.zeros((0, 4, 2), dtype=np.int64), np.zeros(0), True, \
+                    ['no ' + name + '.cbc']
+                continue
+            records = read_cbc(join(dirname, name + '.cbc'))
+            points, doses = cbc_points(records)
+            if isfile(join(dirname, name + '.ccc')):
+                text_points, text_doses = read_ccc(join(dirname, name + '.ccc'))
+                if len(text_points) != len(records):
+                    problems.append('%d shapes in .ccc, %d records in .cbc' % (len(text_points), len(records)))
+                else:
+                    first = (text_points[:, 0, 0] != records['x0']) | (text_points[:, 0, 1] != records['y0'])
+                    if first.any() or (np.rint(text_doses * 100) != records['dose']).any():
+                        problems.append('%d .cbc records differ from .ccc' %
+                                        (first | (np.rint(text_doses * 100) != records['dose'])).sum())
+            yield name, center, size, dots, points, doses, True, problems
+    else:
+        size, centers = read_ctl(join(dirname, base + '.ctl'))
+        dots = dots or FIELD_DOTS['xenos'][0]
+        blocks = set()
+        for name, points, doses in read_pat(join(dirname, base + '.pat')):
+            blocks.add(name)
+            problems = [] if name in centers else ['not in .ctl']
+            yield name, centers.get(name, (0, 0)), size, dots, points, doses, False, problems
+        for name in centers:
+            if name not in blocks:
+                yield name, centers[name], size, dots, np.zeros((0, 4, 2), dtype=np.int64), np.zeros(0), False, \
+                    ['no block in .pat']
+
+
+def field_box(center, size, dbu, boxes=None):
+    # box of a field in database units: the box of the field layer with this center or a square of the field size
+    cx, cy = round(center[0] / dbu), round(center[1] / dbu)
+    for box in boxes or ():
+        if abs(box.center().x - cx) <= 1 and abs(box.center().y - cy) <= 1:
+            return box
+    half = size / dbu / 2
+    return pya.Box(round(cx - half), round(cy - half), round(cx + half), round(cy + half))
+
+
+def to_layout(points, box, coef, flip):
+    # points in dots to database units
+    x = box.left + points[..., 0] / coef
+    y = box.top - points[..., 1] / coef if flip else box.bottom + points[..., 1] / coef
+    return np.rint(np.stack([x, y], -1)).astype(np.int64)
+
+
+def areas(points):
+    # areas of trapezoids given as (N, 4, 2) points
+    x, y = points[..., 0].astype(np.float64), points[..., 1].astype(np.float64)
+    return np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1)) / 2
+
+
+def region(points):
+    # region of trapezoids given as (N, 4, 2) points in database units
+    Point = pya.Point
+    return pya.Region([pya.SimplePolygon([Point(a, b), Point(c, d), Point(e, f), Point(g, h)], True)
+                       for (a, b), (c, d), (e, f), (g, h) in points.tolist()])
+
+
+class Source:
+    """ Shapes of the converted layers of the layout, looked up per field """
+
+    def __init__(self, ly, cell, layers, dose, field_layer=''):
+        self.ly = ly
+        self.cell = cell
+        self.dose = dose
+        self.layers = []
+        self.boxes = []
+        resolver = DoseResolver()
+        for layer_index in layers:
+            info = ly.get_info(layer_index)
+            if str(info.layer) + '/' + str(info.datatype) == field_layer:
+                self.boxes = [poly.bbox() for _, poly in resolver.each_polygon(cell, layer_index) if poly.is_box()]
+            else:
+                self.layers.append(layer_index)
+
+    def shapes(self, box):
+        # (dose, polygon) of all shapes clipped to the box, dose of the converter for shapes without one
+        resolver = DoseResolver()
+        for layer_index in self.layers:
+            for d, poly in resolver.each_polygon(self.cell, layer_index, region=box):
+                if poly is None:
+                    continue  # texts
+                d = d if d is not None else self.dose
+                if poly.bbox().inside(box):
+                    yield d, poly
+                    continue
+                for piece in pya.EdgeProcessor().boolean_p2p([poly], [pya.Polygon(box)],
+                                                             pya.EdgeProcessor.ModeAnd, True, True):
+                    yield d, piece
+
+
+class Report:
+    def __init__(self, name, shots, problems):
+        self.name = name
+        self.shots = shots
+        self.problems = problems
+        self.area = 0.0  # um^2 of all shots
+        self.source_area = None
+        self.mismatch = None  # um^2 of the XOR above the tolerance
+        self.lost = None
+        self.extra = None
+        self.dropped = None
+        self.doses = {}  # dose -> [shots, area in um^2]
+        self.source_doses = {}
+
+    @property
+    def failed(self):
+        return bool(self.problems) or bool(self.mismatch)
+
+    def __str__(self):
+        line = '%s: %d shots, %.3f um^2' % (self.name, self.shots, self.area)
+        if self.source_area is not None:
+            line += ', source %.3f um^2, mismatch %.4f um^2 (lost %.4f, extra %.4f), %d dropped shapes' % (
+                self.source_area, self.mismatch, self.lost, self.extra, self.dropped)
+        line += '\n    doses: ' + ', '.join('%g us: %d shots %.3f um^2' % (d, n, a)
+                                           for d, (n, a) in sorted(self.doses.items()))
+        if self.source_doses:
+            line += '\n    source doses: ' + ', '.join('%g us: %.3f um^2' % (d, a)
+                                                      for d, a in sorted(self.source_doses.items()))
+        for problem in self.problems:
+            line += '\n    ' + problem
+        return line
+
+
+def verify(dirname, ebl, source=None, dbu=0.001, dots=None, tolerance=2.0):
+    """
+    Generator of a Report for every field of the output directory.
+    source: Source of the conversion, only the output is read without it.
+    tolerance: width in dots of XOR slivers which do not count as mismatch
+    """
+    dbu = source.ly.dbu if source is not None else dbu
+    for name, center, size, fdots, points, doses, flip, problems in read_output(dirname, ebl, dots):
+        box = field_box(center, size, dbu, source.boxes if source is not None else None)
+        coef = fdots / (size / dbu)
+        layout_points = to_layout(points, box, coef, flip)
+        report = Report(name, len(points), problems)
+        shot_areas = areas(layout_points) * dbu ** 2
+        report.area = float(shot_areas.sum())
+        values, index = np.unique(doses, return_inverse=True)
+        for dose, n, area in zip(values.tolist(), np.bincount(index, minlength=len(values)).tolist(),
+                                 np.bincount(index, shot_areas, minlength=len(values)).tolist()):
+            report.doses[dose] = [n, area]
+        if source is not None:
+            output = region(layout_points).merged()
+            raw = pya.Region()
+            raw.merged_semantics = False
+            source_doses = defaultdict(float)
+            for dose, piece in source.shapes(box):
+                raw.insert(piece)
+                source_doses[dose] += piece.area() * dbu ** 2
+            report.source_doses = dict(source_doses)
+            merged = raw.merged()
+            report.source_area = merged.area() * dbu ** 2
+            lost, extra = merged - output, output - merged
+            # slivers narrower than the tolerance are removed by an opening
+            d = int(ceil(tolerance / coef / 2))
+            report.lost = (lost.sized(-d).sized(d) & lost).area() * dbu ** 2
+            report.extra = (extra.sized(-d).sized(d) & extra).area() * dbu ** 2
+            report.mismatch = report.lost + report.extra
+            # shapes without any overlap with the output lie entirely in the lost area
+            report.dropped = raw.inside(lost).count()
+        yield report
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='python -m con_creator.verify',
+                                     description='Read converted EBL files and compare them with the layout.')
+    parser.add_argument('output', help='output directory of the conversion')
+    parser.add_argument('--ebl', choices=['cabl', 'xenos'], default='cabl')
+    parser.add_argument('--input', help='GDS or OASIS file of the conversion, only the output is read without it')
+    parser.add_argument('--cell', help='top cell name, the top cell of the layout by default')
+    parser.add_argument('--layers', nargs='+', metavar='L/D', help='converted layers, all layers by default')
+    parser.add_argument('--field-layer', default='', metavar='L/D', help='layer with boxes defining fields')
+    parser.add_argument('--dose', type=float, default=0.0, help='default dose of the conversion in us')
+    parser.add_argument('--field-dots', type=int, help='field resolution in dots of Xenos output')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='ignored width of differences in dots')
+    parser.add_argument('--quiet', action='store_true', help='report failed fields only')
+    return parser
+
+
+def run(args, outlog, ly=None):
+    # verification of one output directory, True if no field failed
+    source = None
+    if args.input or ly is not None:
+        from con_creator.cli import get_layers
+        if ly is None:
+            ly = pya.Layout()
+            ly.read(args.input)
+        cell = ly.cell(args.cell) if args.cell else ly.top_cell()
+        source = Source(ly, cell, get_layers(ly, args.layers, args.field_layer), args.dose, args.field_layer)
+    totals = defaultdict(float)
+    failed = 0
+    for report in verify(abspath(expanduser(args.output)), args.ebl, source, dots=args.field_dots,
+                         tolerance=args.tolerance):
+        failed += report.failed
+        totals['fields'] += 1
+        totals['shots'] += report.shots
+        totals['mismatch'] += report.mismatch or 0
+        totals['dropped'] += report.dropped or 0
+        if report.failed or not args.quiet:
+            outlog.write(str(report), '\n')
+    outlog.write('Verified ', int(totals['fields']), ' fields, ', int(totals['shots']), ' shots')
+    if source is not None:
+        outlog.write(', mismatch ', round(totals['mismatch'], 4), ' um^2, ', int(totals['dropped']), ' dropped shapes')
+    outlog.write(', ', failed, ' fields failed.\n')
+    return failed == 0
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    return 0 if run(args, StreamLog()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,235 @@
-import pya
+"""
+Insertion of SEM images listed in info.csv (written by "Image preparation.ipynb") into the current view.
+
+Every image is read once and cached as a pyramid of tiles in <dirname>/.tiles: level 0 has the full
+resolution, every next level half of it, the last one fits into a single tile. The view gets the last
+level of all images first, in transactions of a few images. When the view is moved or zoomed, images on
+screen get tiles of the level the zoom needs, but only tiles on screen, and tiles leaving the screen are
+removed. Memory follows the screen instead of the amount and size of images.
+"""
 import os
-import numpy as np 
-import pandas as pd
-
-dirname = "/home"
-
-df = pd.read_csv(os.path.join(dirname, "info.csv"), header=None)
-for i, row in df.iterrows():
-    pic = pya.Image(row.iloc[0])
-    old_pts = [pya.DPoint(*row.iloc[1:3]), pya.DPoint(*row.iloc[3:5]), pya.DPoint(*row.iloc[5:7]), pya.DPoint(*row.iloc[7:9])]
-    new_pts = [pya.DPoint(*row.iloc[9:11]), pya.DPoint(*row.iloc[11:13]), pya.DPoint(*row.iloc[13:15]), pya.DPoint(*row.iloc[15:17])]
-    matrix = pya.Matrix3d()
-    matrix.adjust(old_pts, new_pts, pya.Matrix3d.AdjustAll, -1)
-    pic = pic.transformed(matrix)
-    pya.Application.instance().main_window().current_view().insert_image(pic) 
\ No newline at end of file
+import csv
+import json
+import hashlib
+from math import floor, log2
+import numpy as np
+import pya
+try:
+    import cv2 as cv
+except ImportError:
+    cv = None
+
+TILE = 512  # pixels of a tile side
+BATCH = 20  # images inserted in one transaction
+MAX_TILES = 200  # detail tiles shown at once, coarser levels are used above
+
+
+def read_rows(path):
+    # (image path, matrix from pixels to um) for every line of info.csv, the file is read line by line
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            values = [float(v) for v in row[1:17]]
+            old_pts = [pya.DPoint(*values[k:k + 2]) for k in range(0, 8, 2)]
+            new_pts = [pya.DPoint(*values[k:k + 2]) for k in range(8, 16, 2)]
+            matrix = pya.Matrix3d()
+            matrix.adjust(old_pts, new_pts, pya.Matrix3d.AdjustAll, -1)
+            yield row[0], matrix
+
+
+def load_channels(path):
+    """
+    Pixel values of an image as list of arrays (one for monochrome, red, green and blue for color images)
+    with the lowest row first, and the maximum value
+    """
+    if cv is not None:
+        data = cv.imread(path, cv.IMREAD_UNCHANGED)
+        if data is not None:
+            top = np.iinfo(data.dtype).max if data.dtype.kind in 'ui' else float(data.max())
+            data = data[::-1]
+            if data.ndim == 2:
+                return [data], top
+            return [data[..., 2], data[..., 1], data[..., 0]], top
+    img = pya.Image(path)
+    w, h = img.width(), img.height()
+    if img.is_color():
+        return [np.array(img.data(c), dtype=np.float32).reshape(h, w) for c in range(3)], img.max_value
+    return [np.array(img.data(), dtype=np.float32).reshape(h, w)], img.max_value
+
+
+def halve(a):
+    # next level of the pyramid, mean of 2x2 pixels
+    h, w = a.shape[0] // 2 * 2, a.shape[1] // 2 * 2
+    a = a[:h, :w].astype(np.float32)
+    return ((a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]) / 4).astype(np.float32)
+
+
+class Pyramid:
+    """
+    Tiles of one image in the cache. The cache directory is named after the content
+    of the file, so changed images get new tiles
+    """
+
+    def __init__(self, path, cache):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        self.path = path
+        self.dir = os.path.join(cache, os.path.basename(path) + '_' + digest.hexdigest()[:16])
+        meta = os.path.join(self.dir, 'meta.json')
+        if not os.path.isfile(meta):
+            self.build(meta)
+        with open(meta) as f:
+            self.meta = json.load(f)
+        self.width, self.height = self.meta['sizes'][0]
+        self.top = len(self.meta['sizes']) - 1  # level of a single tile
+
+    def build(self, meta):
+        os.makedirs(self.dir, exist_ok=True)
+        channels, top = load_channels(self.path)
+        sizes = []
+        while True:
+            h, w = channels[0].shape
+            sizes.append((w, h))
+            for iy in range(0, h, TILE):
+                for ix in range(0, w, TILE):
+                    tile = np.stack([c[iy:iy + TILE, ix:ix + TILE] for c in channels])
+                    np.save(self.tile_path(len(sizes) - 1, ix // TILE, iy // TILE), tile)
+            if max(w, h) <= TILE or min(w, h) < 2:
+                break
+            channels = [halve(c) for c in channels]
+        with open(meta, 'w') as f:
+            json.dump({'sizes': sizes, 'max_value': float(top)}, f)
+
+    def tile_path(self, level, ix, iy):
+        return os.path.join(self.dir, 'L%d_%d_%d.npy' % (level, ix, iy))
+
+    def scale(self, level):
+        # original pixels per pixel of the level along x and y
+        w, h = self.meta['sizes'][level]
+        return self.width / w, self.height / h
+
+    def tiles(self, level, box=None):
+        # (ix, iy) of tiles of the level touching box given in centered pixels of the original image
+        w, h = self.meta['sizes'][level]
+        nx, ny = (w + TILE - 1) // TILE, (h + TILE - 1) // TILE
+        if box is None:
+            return [(ix, iy) for ix in range(nx) for iy in range(ny)]
+        sx, sy = self.scale(level)
+        x0 = max(0, int(floor((box.left / sx + w / 2) / TILE)))
+        x1 = min(nx - 1, int(floor((box.right / sx + w / 2) / TILE)))
+        y0 = max(0, int(floor((box.bottom / sy + h / 2) / TILE)))
+        y1 = min(ny - 1, int(floor((box.top / sy + h / 2) / TILE)))
+        return [(ix, iy) for ix in range(x0, x1 + 1) for iy in range(y0, y1 + 1)]
+
+    def image(self, level, ix, iy, matrix):
+        # tile as pya.Image placed by matrix of the original image
+        data = np.load(self.tile_path(level, ix, iy))
+        th, tw = data.shape[1:]
+        w, h = self.meta['sizes'][level]
+        if len(data) == 3:
+            img = pya.Image(tw, th, *[c.ravel().tolist() for c in data])
+        else:
+            img = pya.Image(tw, th, data[0].ravel().tolist())
+        img.max_value = self.meta['max_value']
+        sx, sy = self.scale(level)
+        cx = ix * TILE + tw / 2 - w / 2
+        cy = iy * TILE + th / 2 - h / 2
+        img = img.transformed(matrix * pya.Matrix3d(sx, 0, cx * sx, 0, sy, cy * sy, 0, 0, 1))
+        img.z_position = self.top - level  # finer levels above coarser ones
+        return img
+
+
+class TiledImages:
+    """ Images of info.csv in the view, detail tiles follow the visible area """
+
+    def __init__(self, view, dirname, cache=None):
+        self.view = view
+        self.cache = cache or os.path.join(dirname, '.tiles')
+        self.entries = []  # [pyramid, matrix, box in um, {(level, ix, iy): image id}]
+        self.timer = None
+
+    def insert_all(self, path):
+        rows = read_rows(path)
+        while True:
+            batch = [row for _, row in zip(range(BATCH), rows)]
+            if not batch:
+                break
+            self.view.transaction('Insert images')
+            try:
+                for image_path, matrix in batch:
+                    self.insert(image_path, matrix)
+            finally:
+                self.view.commit()
+
+    def insert(self, image_path, matrix):
+        pyramid = Pyramid(image_path, self.cache)
+        img = pyramid.image(pyramid.top, 0, 0, matrix)
+        self.view.insert_image(img)
+        self.entries.append([pyramid, matrix, img.box(), {}])
+
+    def level(self, pyramid, box, screen):
+        # finest level needed: one pixel of the level is not smaller than one pixel of the screen
+        um_per_pixel = box.width() / pyramid.width
+        if um_per_pixel <= 0:
+            return pyramid.top
+        return min(pyramid.top, max(0, int(floor(log2(max(screen / um_per_pixel, 1))))))
+
+    def refresh(self):
+        """ Detail tiles for images on screen, all other detail tiles are removed """
+        view_box = self.view.box()
+        screen = view_box.width() / max(1, self.view.viewport_width())  # um per screen pixel
+        wanted = []
+        for entry in self.entries:
+            pyramid, matrix, box, shown = entry
+            keys = set()
+            if box.overlaps(view_box):
+                level = self.level(pyramid, box, screen)
+                if level < pyramid.top:
+                    inverse = matrix.inverted()
+                    area = pya.DBox()
+                    for p in (view_box.p1, view_box.p2, pya.DPoint(view_box.left, view_box.top),
+                              pya.DPoint(view_box.right, view_box.bottom)):
+                        area += inverse.trans(p)
+                    keys = {(level, ix, iy) for ix, iy in pyramid.tiles(level, area)}
+            wanted.append(keys)
+        # too many tiles on screen: coarser tiles of all images instead
+        while sum(map(len, wanted)) > MAX_TILES and any(wanted):
+            wanted = [{(level + 1, ix // 2, iy // 2) for level, ix, iy in keys
+                       if level + 1 < entry[0].top} for keys, entry in zip(wanted, self.entries)]
+
+        self.view.transaction('Image tiles')
+        try:
+            for entry, keys in zip(self.entries, wanted):
+                pyramid, matrix, _, shown = entry
+                for key in list(shown):
+                    if key not in keys:
+                        self.view.erase_image(shown.pop(key))
+                for key in keys - set(shown):
+                    img = pyramid.image(*key, matrix)
+                    self.view.insert_image(img)
+                    shown[key] = img.id()
+        finally:
+            self.view.commit()
+
+    def follow(self, delay=300):
+        # tiles are updated once the view stops moving
+        self.timer = pya.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout(self.refresh)
+        self.view.on_viewport_changed += self.viewport_changed
+
+    def viewport_changed(self):
+        self.timer.start()
+
+
+if __name__ == '__main__':
+    dirname = "/home"
+
+    images = TiledImages(pya.Application.instance().main_window().current_view(), dirname)
+    images.insert_all(os.path.join(dirname, "info.csv"))
+    images.refresh()
+    images.follow()
@@ -0,0 +1,460 @@
+"""
+Detection of four alignment crosses on SEM images and the info.csv read by image_insert.py.
+Used by "Image preparation.ipynb":
+
+    from preparation import add_images_QDEV
+    df = add_images_QDEV(dirname, threshold='Binary', processes=4)
+
+Images are detected in a pool of processes. Results are cached in <dirname>/.crosses.json under a key
+made of the content of the image (and of its _sup image) and the detection parameters, so only new
+or changed images are detected again. The cache is saved while the images are detected, images which
+fail (e.g. corrupt files) are reported and left out of info.csv without stopping the others.
+
+Two engines find the crosses: 'contours' searches contours of the thresholded image in full resolution,
+'projection' searches cross shaped components on a level of the Gaussian pyramid and refines their centers
+by projections of small regions of the full image. benchmarks/crosses.py compares them on synthetic images.
+"""
+import os
+import json
+import hashlib
+import random as rnd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import peakutils
+import cv2 as cv
+
+image_formats = set(["png", "jpg", "tif", "tiff"])
+CACHE = '.crosses.json'
+VERSION = 1  # changes of the detection invalidate cached results
+SAVE_EVERY = 50  # new results between saves of the cache
+
+
+def get_coords(cnt):
+    x, y = cnt.T[0][0], cnt.T[1][0]
+    histx, binsx = np.histogram(x, bins=min(200, max(x)-min(x)))
+    indsx = peakutils.indexes(histx, min_dist=3, thres=0.3)
+
+    if len(indsx) > 2:
+        new = sorted(indsx, key=lambda i: histx[i])
+        indsx = np.array(new[-2:])
+
+    histy, binsy = np.histogram(y, bins=min(200, max(y)-min(y)))
+    indsy = peakutils.indexes(histy, min_dist=3, thres=0.3)
+
+    if len(indsy) > 2:
+        new = sorted(indsy, key=lambda i: histy[i])
+        indsy = np.array(new[-2:])
+
+    if len(indsx) < 2 or len(indsy) < 2:
+        return None
+    return np.array([binsx[indsx[1]] + binsx[indsx[0]], binsy[indsy[1]] + binsy[indsy[0]]], dtype='int64') // 2
+
+
+def imread(path, flags=cv.IMREAD_COLOR):
+    # cv.imread returns None for missing or corrupt files
+    img = cv.imread(path, flags)
+    if img is None:
+        raise OSError('cannot read image ' + path)
+    return img
+
+
+def find_contours(path, sup_path, annotation, threshold='Adaptive'):
+    '''
+    Contours of the crosses and their centers in pixels relative to the image center (y upwards),
+    sorted from bottom left to top right. Less or more than 4 centers if the crosses were not found
+    '''
+    old_pts = []
+    plot_contours = []
+    orig_img = imread(path)
+    size_thres = min(orig_img.shape[:1]) * 0.06
+
+    img = orig_img
+    if sup_path is not None:
+        img = imread(sup_path)
+        size_thres /= 2
+
+    if annotation is not None:
+        img = img[:int(img.shape[0] * (1-annotation))]
+
+    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    equ = cv.equalizeHist(gray)
+    if threshold == 'Adaptive':
+        thresh = cv.adaptiveThreshold(equ, 255, cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, 61, 0)
+    else:
+        _, thresh = cv.threshold(equ, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    kernel = np.ones((2, 2), np.uint8)
+
+    # Iteration over opening 'iterations' -- increasing contrast and
+    # checking if it is possible to distinguish 4 differenet crosses
+    itera = 1
+    while len(old_pts) != 4 and itera < 5:
+        old_pts = []
+        plot_contours = []
+        opening = cv.morphologyEx(thresh, cv.MORPH_OPEN, kernel, iterations=itera)
+        contours, hierarchy = cv.findContours(opening, cv.RETR_TREE, cv.CHAIN_APPROX_NONE)
+
+        for cnt in contours:
+            x, y, w, h = cv.boundingRect(cnt)
+            if w > size_thres and h > size_thres:
+                M = cv.moments(cnt)
+                centroid = np.array([int(M['m10'] / M['m00']), int(M['m01'] / M['m00'])])
+                bbox_center = np.array([x + w / 2, y + h / 2])
+                center = get_coords(cnt)
+                if center is not None:
+                    if w / h < 1.33 and w / h > 0.75 and np.linalg.norm(centroid - center) < 0.2 * max(w, h) and\
+                            np.linalg.norm(centroid - bbox_center) < 0.2 * max(w, h) or sup_path is not None:
+                        plot_contours.append(cnt)
+                        old_pts.append([center[0] - orig_img.shape[1]/2, -center[1] + orig_img.shape[0]/2 + 1])
+        itera += 1
+
+    order = sorted(range(len(old_pts)), key=lambda k: 2*np.sign(old_pts[k][1]) + np.sign(old_pts[k][0]))
+    return [plot_contours[k] for k in order], [[float(c) for c in old_pts[k]] for k in order]
+
+
+def read_gray(path, sup_path, annotation):
+    # grayscale image used for detection (the _sup image if given) and (height, width) of the original
+    orig = imread(path, cv.IMREAD_GRAYSCALE)
+    gray = orig if sup_path is None else imread(sup_path, cv.IMREAD_GRAYSCALE)
+    if annotation is not None:
+        gray = gray[:int(gray.shape[0] * (1-annotation))]
+    return gray, orig.shape
+
+
+def binarize(small):
+    """
+    Foreground masks of bright and of dark crosses: pixels differing from the median of their neighbourhood
+    by more than 5 standard deviations of the noise. Gradients of the background and the brightness
+    of the image do not matter, so no threshold has to be chosen
+    """
+    ksize = min(255, max(small.shape) // 8 // 2 * 2 + 1)
+    diff = small.astype(np.float32) - cv.medianBlur(small, ksize)
+    sigma = max(1.0, 1.4826 * float(np.median(np.abs(diff - np.median(diff)))))
+    return (diff > 5*sigma).astype(np.uint8), (diff < -5*sigma).astype(np.uint8)
+
+
+def cross_candidates(mask, size_thres, sup):
+    # boxes (x, y, w, h) of components shaped like crosses, the 4 largest ones
+    n, labels, stats, centroids = cv.connectedComponentsWithStats(mask, connectivity=8)
+    found = []
+    for k in range(1, n):
+        x, y, w, h, area = stats[k]
+        if w <= size_thres or h <= size_thres or x == 0 or y == 0 or \
+                x + w == mask.shape[1] or y + h == mask.shape[0]:
+            continue
+        if not sup:
+            bbox_center = np.array([x + (w-1) / 2, y + (h-1) / 2])
+            # arms are thinner than the cross, the middle of the box belongs to both arms
+            if not (0.75 < w / h < 1.33 and 0.1 < area / (w*h) < 0.7 and
+                    np.linalg.norm(centroids[k] - bbox_center) < 0.2 * max(w, h) and
+                    labels[int(round(bbox_center[1])), int(round(bbox_center[0]))] == k):
+                continue
+        found.append((area, (x, y, w, h)))
+    found.sort(reverse=True)
+    return [box for _, box in found[:4]] if len(found) >= 4 else None
+
+
+def profile_center(profile):
+    # sub-pixel position of the arm across the profile: weighted mean of the columns above half height
+    base = np.median(profile)
+    weights = profile - base
+    weights[profile < (profile.max() + base) / 2] = 0
+    if weights.sum() <= 0:
+        return None
+    return float((weights * np.arange(len(profile))).sum() / weights.sum())
+
+
+def refine(gray, box, scale, bright):
+    """
+    Center of a cross in pixels of gray: the box found on the level (scale pixels per its pixel) is
+    enlarged by two pixels of the level, its pixels are scaled between background and cross and summed
+    along rows and columns, the arms are the maxima of both projections
+    """
+    x, y, w, h = box
+    x0, y0 = max(0, (x-2) * scale), max(0, (y-2) * scale)
+    roi = gray[y0:(y+h+2) * scale, x0:(x+w+2) * scale]
+    t, _ = cv.threshold(roi, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    roi = roi.astype(np.float32)
+    fg, bg = roi[roi > t], roi[roi <= t]
+    if not bright:
+        fg, bg = bg, fg
+    if fg.size == 0 or bg.size == 0:
+        return None
+    soft = np.clip((roi - bg.mean()) / (fg.mean() - bg.mean()), 0, 1)
+    cx, cy = profile_center(soft.sum(axis=0)), profile_center(soft.sum(axis=1))
+    if cx is None or cy is None:
+        return None
+    return x0 + cx, y0 + cy
+
+
+def find_projection(path, sup_path=None, annotation=None, size=512):
+    """
+    Centers of the 4 crosses like find_contours, searched on a level of the Gaussian pyramid not larger than size
+    (bright crosses first, then dark ones). Every cross is refined to sub-pixel accuracy in its region of the
+    full image. None if the crosses were not found
+    """
+    gray, (height, width) = read_gray(path, sup_path, annotation)
+    small, level = gray, 0
+    while max(small.shape) > size:
+        small = cv.pyrDown(small)
+        level += 1
+    scale = 2**level
+    size_thres = height * 0.06 / scale / (2 if sup_path is not None else 1)
+    for bright, mask in zip((True, False), binarize(small)):
+        boxes = cross_candidates(mask, size_thres, sup_path is not None)
+        if boxes is None:
+            continue
+        centers = [refine(gray, box, scale, bright) for box in boxes]
+        if None in centers:
+            continue
+        old_pts = [[float(cx - width/2), float(-cy + height/2 + 1)] for cx, cy in centers]
+        return sorted(old_pts, key=lambda p: 2*np.sign(p[1]) + np.sign(p[0]))
+    return None
+
+
+def find_crosses(path, sup_path=None, annotation=None, threshold='Adaptive', engine='contours'):
+    # centers of the 4 crosses (see find_contours), None if they were not found
+    if engine == 'projection':
+        return find_projection(path, sup_path, annotation)
+    _, old_pts = find_contours(path, sup_path, annotation, threshold)
+    return old_pts if len(old_pts) == 4 else None
+
+
+def new_points(p0, step):
+    '''
+    p0 - coords of left bottom cross on image (in um)
+    step - step in um from bottom left cross to the top right
+    supposed that crosses are vertexes of a rectangle
+    '''
+    i = np.array([1, 0])
+    j = np.array([0, 1])
+    return np.array([p0, p0 + step*i, p0 + step*j, p0 + step])
+
+
+def info_row(path, old_pts, p0, step):
+    # line of info.csv: image path, 4 crosses in pixels, 4 crosses in um
+    return [path] + list(np.array(old_pts).flatten()) + list(new_points(p0, step).flatten())
+
+
+def preview(path, sup_path, annotation, threshold='Adaptive', engine='contours'):
+    # figure with contours (of the contours engine) and centers of the crosses, detected again
+    if engine == 'projection':
+        old_pts = find_projection(path, sup_path, annotation) or []
+        contours = None
+    else:
+        contours, old_pts = find_contours(path, sup_path, annotation, threshold)
+    return plot_crosses(path, old_pts, contours)
+
+
+def plot_crosses(path, old_pts, contours=None):
+    # figure of the image with the given centers of crosses (see find_contours) and their contours if known
+    from matplotlib import pyplot as plt
+    old_pts = old_pts or []
+    contours = contours or [None] * len(old_pts)
+    plot_img = cv.imread(path)
+    thickness = max(1, plot_img.shape[0] // 400)
+    for cnt, (px, py) in zip(contours, old_pts):
+        center = (int(round(px + plot_img.shape[1] / 2)), int(round(plot_img.shape[0] / 2 + 1 - py)))
+        if cnt is not None:
+            x, y, w, h = cv.boundingRect(cnt)
+            cv.rectangle(plot_img, (x, y), (x + w, y + h), (0, 255, 0), thickness)
+            color = (rnd.randint(0, 256), rnd.randint(0, 256), rnd.randint(0, 256))
+            cv.drawContours(plot_img, [cnt], 0, color, thickness, cv.LINE_8)
+        cv.circle(plot_img, center, max(1, plot_img.shape[0] // 200), (0, 0, 255), -1)
+    fig, ax = plt.subplots(figsize=(7, 7 * plot_img.shape[0]/plot_img.shape[1]))
+    fig.tight_layout()
+    ax.imshow(plot_img, interpolation='none', cmap='gray')
+    return fig
+
+
+def addpic(path, sup_path, p0, step, annotation, threshold='Adaptive', engine='contours'):
+    # one line of info.csv as DataFrame, None if 4 crosses were not found
+    old_pts = find_crosses(path, sup_path, annotation, threshold, engine)
+    if old_pts is None:
+        return None
+    return pd.DataFrame([info_row(path, old_pts, p0, step)])
+
+
+def split_name(dirname, i):
+    # path, parts of the name split by '_' and path of the _sup image, None for other files
+    path = os.path.join(dirname, i)
+    if not os.path.isfile(path):
+        return None
+    parts = i.split('.')
+    if parts[-1] not in image_formats:
+        return None
+    name = ".".join(parts[0:-1]).split('_')
+    if name[-1] == 'sup':
+        return None
+    sup_path = os.path.join(dirname, '_'.join(name) + '_sup.' + parts[-1])
+    return path, name, sup_path if os.path.isfile(sup_path) else None
+
+
+def multifield_jobs(dirname, offset, macrostep, step, infield_shifts, multifields):
+    # (path, sup_path, p0, step) of images named ..._f<field>[_l|_r]_<x>_<y>
+    for i in sorted(os.listdir(dirname)):
+        split = split_name(dirname, i)
+        if split is None:
+            continue
+        path, name, sup_path = split
+        if len(name) >= 3 and not multifields:
+            if name[-3][:-1] != "f" and name[-3][:-1] != "F" and name[-3][:-1] != "field":
+                print("Supposedly auxillary image", i, "was not inserted")
+                continue
+            field = int(name[-3][-1])
+            shift = macrostep * np.array([(field - 1) % 2, (field - 1) // 2])
+            infield_shift = infield_shifts[0]
+
+        elif len(name) >= 4 and multifields:
+            if name[-4][:-1] != "f" and name[-4][:-1] != "F" and name[-4][:-1] != "field":
+                print("Supposedly auxillary image", i, "was not inserted")
+                continue
+            field = int(name[-4][-1])
+            infield = name[-3]
+            shift = macrostep * np.array([(field-1) % 2, (field-1) // 2])
+            if infield == 'r':
+                infield_shift = infield_shifts[1]
+            elif infield == 'l':
+                infield_shift = infield_shifts[0]
+            else:
+                print("Wrong filename. Image", i, "was not inserted")
+                continue
+
+        else:
+            print("Wrong filename. Image", i, "was not inserted")
+            continue
+        p0 = offset + shift + infield_shift + np.array([int(name[-2])-1, int(name[-1])-1]) * step
+        yield path, sup_path, p0, step
+
+
+def qdev_jobs(dirname, macrooffset, offset, macrostep, step, ministep):
+    # (path, sup_path, p0, step) of images named ..._f<field>_<x>_<y>_<x>_<y>
+    for i in sorted(os.listdir(dirname)):
+        split = split_name(dirname, i)
+        if split is None:
+            continue
+        path, name, sup_path = split
+        if len(name) >= 6:
+            if name[-5][0] != "f" and name[-5][0] != "F" and name[-5][:-1] != "field":
+                print("Supposedly auxillary image", i, "was not inserted")
+                continue
+            field = int(name[-5][1:])
+            shift = macrooffset + macrostep*np.array([(field-1) % 4, (field-1) // 4])
+            shift += step*np.array([int(name[-4])-1, int(name[-3])-1])
+            p0 = shift + offset + ministep*np.array([int(name[-2])-1, int(name[-1])-1])
+        else:
+            print("Wrong filename. Image", i, "was not inserted")
+            continue
+        yield path, sup_path, p0, ministep
+
+
+def file_digest(path, files):
+    # sha1 of the file content, files caches digests by path, size and modification time
+    stat = os.stat(path)
+    known = files.get(path)
+    if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known[2]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    files[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return files[path][2]
+
+
+def detect(task):
+    # worker of the process pool: centers of the crosses (None if not found) and message of an exception
+    try:
+        return find_crosses(*task), None
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e)
+
+
+def detect_all(todo, processes):
+    # (key, centers, message) of all tasks of todo (key -> task of detect) in order of completion
+    if processes == 1:
+        for key, task in todo.items():
+            yield (key,) + detect(task)
+        return
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {pool.submit(detect, task): key for key, task in todo.items()}
+        for future in as_completed(futures):
+            try:
+                yield (futures[future],) + future.result()
+            except Exception as e:  # the worker process died
+                yield futures[future], None, '%s: %s' % (type(e).__name__, e)
+
+
+def save_cache(cache_path, files, results):
+    # written to a temporary file first, an interrupted save keeps the previous cache
+    with open(cache_path + '.part', 'w') as f:
+        json.dump({'files': files, 'results': results}, f)
+    os.replace(cache_path + '.part', cache_path)
+
+
+def run_jobs(dirname, jobs, annotation=None, threshold='Adaptive', processes=None, show=False, engine='contours'):
+    '''
+    Detects crosses of all jobs (path, sup_path, p0, step) and writes info.csv in one pass.
+    engine - 'contours' or 'projection' (faster, sub-pixel centers, threshold is not used)
+    processes - size of the process pool, number of CPUs by default, 1 detects in this process
+    show - figure with the found centers for every image, preview() shows contours of a single image
+    Images whose detection fails are reported and left out, the cache keeps all finished results
+    even if the detection is interrupted
+    '''
+    cache_path = os.path.join(dirname, CACHE)
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    files, results, errors = cache.get('files', {}), cache.get('results', {}), {}
+
+    jobs = list(jobs)
+    keys = []
+    for path, sup_path, _, _ in jobs:
+        digests = [file_digest(p, files) for p in (path, sup_path) if p is not None]
+        keys.append(hashlib.sha1(json.dumps([VERSION, digests, annotation, threshold, engine]).encode()).hexdigest())
+    todo = {key: (path, sup_path, annotation, threshold, engine)
+            for key, (path, sup_path, _, _) in zip(keys, jobs) if key not in results}
+    try:
+        for n, (key, old_pts, error) in enumerate(detect_all(todo, processes), 1):
+            # failed images are not cached, they are detected again by the next run
+            if error is None:
+                results[key] = old_pts
+            else:
+                errors[key] = error
+            if n % SAVE_EVERY == 0:
+                save_cache(cache_path, files, results)
+    finally:
+        save_cache(cache_path, files, results)
+
+    rows = []
+    for key, (path, sup_path, p0, step) in zip(keys, jobs):
+        old_pts = results.get(key)
+        if key in errors:
+            print("Detection failed in", os.path.basename(path), "-", errors[key])
+            continue
+        if old_pts is None:
+            print("Cannot find 4 crosses in", os.path.basename(path))
+        else:
+            rows.append(info_row(path, old_pts, p0, step))
+        if show:
+            plot_crosses(path, old_pts)
+    full_df = pd.DataFrame(rows)
+    full_df.to_csv(os.path.join(dirname, "info.csv"), header=None, index=False)
+    return full_df
+
+
+def add_images(dirname, offset=np.array([0, 0]), macrostep=np.array([0, 0]), step=np.array([0, 0]),
+               infield_shifts=np.array([np.array([0, 0]), np.array([0, 0])]), annotation=None,
+               multifields=True, threshold='Adaptive', processes=None, show=False, engine='contours'):
+    jobs = multifield_jobs(dirname, offset, macrostep, step, infield_shifts, multifields)
+    return run_jobs(dirname, jobs, annotation, threshold, processes, show, engine)
+
+
+def add_images_QDEV(dirname, macrooffset=np.array([360, 360]), offset=np.array([10, 12]),
+                    macrostep=np.array([600, 600]), step=np.array([120, 120]),
+                    ministep=np.array([25, 16]), annotation=None, threshold='Adaptive', processes=None, show=False,
+                    engine='contours'):
+    jobs = qdev_jobs(dirname, macrooffset, offset, macrostep, step, ministep)
+    return run_jobs(dirname, jobs, annotation, threshold, processes, show, engine)